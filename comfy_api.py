@@ -1,28 +1,49 @@
-import urllib.request
-import urllib.parse
-import websocket
-import requests
 import json
 import time
+import asyncio
 import threading
 import traceback
 import os
+import uuid
+from collections import OrderedDict
+from functools import partial
+from urllib.parse import urlsplit
+import aiohttp
+import comfy_client as cc
+import comfy_images as ci
+import comfy_events as ev
+import comfy_preview as cp
+import comfy_metrics as cm
 import comfy_task_manager as ctm
+import comfy_journal as cj
+import comfy_uploads as cu
+import result_cache as rc
+import workflow_template as wt
 
 OUTPUT_DIR = "/content/ComfyUI/output"
+VERBOSE = True          # False でジョブごとの通知 (API response / cached result) を出さない (警告・エラーは出す)
+OUTPUT_DIRS = {}        # base url -> output dir (OUTPUT_DIR と異なるバックエンド用)
+# queue_prompt と /ws で共通の client_id (プロセスごとに別。再起動後も実行中の prompt の通知を
+# 受けられるよう、使われていない保存済みのものがあればジャーナルから引き継ぐ)
+# JOURNAL_ENABLED / JOURNAL_PATH を import 後に変えられるよう、最初に使う時に決める
+client_id_lock = threading.Lock()
+client_state = {"id": None}
 
-def make_ws_url(url):
-    host_port = url.replace("http://", "")
-    return f"ws://{host_port}/ws"
+def get_client_id():
+    with client_id_lock:
+        if client_state["id"] is None:
+            client_state["id"] = cj.acquire_client_id(uuid.uuid4().hex)
+        return client_state["id"]
 
-def queue_prompt(base_url, prompt_workflow):
-    payload = {"prompt": prompt_workflow}
-    data = json.dumps(payload).encode("utf-8")
-    headers = {"Content-Type": "application/json"}
-    req = urllib.request.Request(f"{base_url}/prompt", data=data, headers=headers)
+def get_client(base_url):
+    return cc.get_client(base_url, get_client_id())
+
+def make_ws_url(url, client_id=None):
+    return cc.ComfyClient(url, client_id or get_client_id()).ws_url
+
+def queue_prompt(base_url, prompt_workflow, front=False):
     try:
-        response = urllib.request.urlopen(req)
-        return json.loads(response.read().decode("utf-8"))
+        return cc.run_sync(get_client(base_url).queue_prompt(prompt_workflow, front=front))
     except Exception as e:
         print(f"Error queueing prompt: {e}")
         return None
@@ -30,168 +51,413 @@ def queue_prompt(base_url, prompt_workflow):
 def generate_image_with_api(
     base_url, workflow_json, node_ids, positive_prompt, negative_prompt,
     seed, width, height, steps, cfg, sampler_name, scheduler, denoise,
-    model_name, stop_at_clip_layer, filename_prefix="ComfyUI_API"  ):
-
-    prompt = workflow_json.copy()
-    prompt[node_ids["KSampler"]]["inputs"].update({
-        "seed": seed, "steps": steps, "cfg": cfg,
-        "sampler_name": sampler_name, "scheduler": scheduler, "denoise": denoise })
-    prompt[node_ids["EmptyLatentImage"]]["inputs"].update({"width": width, "height": height})
-
-    # --- SDXL対応: text_l, text_g 両方に設定 ---
-    positive_node = prompt[node_ids["PositivePrompt_TextEncode"]]["inputs"]
-    negative_node = prompt[node_ids["NegativePrompt_TextEncode"]]["inputs"]
-
-    positive_node["text"] = positive_prompt
-    positive_node["text_g"] = positive_prompt
-    positive_node["text_l"] = positive_prompt
-
-    negative_node["text"] = negative_prompt
-    negative_node["text_g"] = negative_prompt
-    negative_node["text_l"] = negative_prompt
-    
-    prompt[node_ids["SaveImage"]]["inputs"]["filename_prefix"] = filename_prefix
-    prompt[node_ids["CheckpointLoaderSimple"]]["inputs"]["ckpt_name"] = model_name
-    prompt[node_ids["CLIPSetLastLayer"]]["inputs"]["stop_at_clip_layer"] = stop_at_clip_layer
-
-    prompt_info = queue_prompt(base_url, prompt)        # Queue the prompt
-    print("API response:", prompt_info)
+    model_name, stop_at_clip_layer, filename_prefix="ComfyUI_API", use_cache=None,
+    priority=None, input_image=None, input_mask=None  ):
+
+    # workflow_json は dict でもコンパイル済みテンプレートでもよい (テンプレートは書き換えない)
+    template = wt.compile_template(workflow_json, node_ids)
+    params = dict(
+        positive_prompt=positive_prompt, negative_prompt=negative_prompt,
+        seed=seed, width=width, height=height, steps=steps, cfg=cfg,
+        sampler_name=sampler_name, scheduler=scheduler, denoise=denoise,
+        model_name=model_name, stop_at_clip_layer=stop_at_clip_layer,
+        filename_prefix=filename_prefix)
+
+    # 入力画像 (ローカルパス) はバックエンドへアップロードし、LoadImage には画像名を渡す
+    for param, path in (("input_image", input_image), ("input_mask", input_mask)):
+        if path is None:
+            continue
+        if not template.plan.get(param):
+            print(f"⚠️ {param} given but the workflow has no node to receive it")
+            continue
+        try:
+            params[param] = cu.ensure_uploaded(base_url, path)
+        except Exception as e:
+            print(f"❌ Failed to upload {path}: {e}")
+            return None
+    prompt = template.instantiate(**params)
+
+    # 同一内容のジョブが既に出力済みならサーバーに投げずにその出力を返す
+    use_cache = rc.RESULT_CACHE_ENABLED if use_cache is None else use_cache
+    cache_key = rc.prompt_key(prompt) if use_cache else None
+    hit = rc.lookup(cache_key) if use_cache else None
+    if hit is not None:
+        prompt_id = rc.issue_hit(hit)
+        cm.start(prompt_id, time.time(), checkpoint=model_name, resolution=f"{width}x{height}")
+        info(f"♻️ cached result: {hit['paths'][0]}")
+        return prompt_id
+
+    ensure_ws_receiver(base_url)                        # client_id を先に登録しておく
+    submitted_at = time.time()
+    # 対話ジョブ (priority=ctm.INTERACTIVE) はサーバーのキューの先頭に積み、バッチの後ろで待たせない
+    prompt_info = queue_prompt(base_url, prompt, front=(priority == ctm.INTERACTIVE))
+    info(f"API response: {prompt_info}")
     if not prompt_info or "prompt_id" not in prompt_info:
         print("❌ Failed to queue prompt.")
         return None
 
     prompt_id = prompt_info["prompt_id"]
+    cm.start(prompt_id, submitted_at, checkpoint=model_name, resolution=f"{width}x{height}")
+    cm.mark(prompt_id, cm.ACCEPTED)
+    if cache_key is not None:
+        rc.remember(prompt_id, cache_key)
 #    print(f"⏳ Prompt queued. ID: {prompt_id}")
 
     return prompt_id
 
 
-ws_log_lock = threading.Lock()
-ws_logs = []
-
 def get_ws_log_text():
-    with ws_log_lock:
-        return "\n".join(ws_logs[-100:])
+    return ev.get_log_text()
 
-def websocket_receiver(prompt_id, url):
-    ws_url = make_ws_url(url)
-#    print("🟡 WebSocket receiver started...")
-    while True:  # Keep trying to connect if connection is lost
+def info(msg):
+    if VERBOSE:
+        print(msg)
+
+def ws_log(msg, echo=False, prompt_id=None):
+    ev.log(msg, prompt_id)
+    if echo:
+        print(msg)
+
+
+# --- 1 base URL につき 1 本の WebSocket を共有し、prompt_id で振り分ける ---
+# 受信は comfy_client の共有イベントループ上のコルーチンで行う (スレッドは増えない)。
+# ハンドラはループ上で呼ばれるので、ブロッキング処理はしないこと。
+ws_lock = threading.Lock()
+ws_receivers = {}       # base url -> receiver future
+ws_handlers = {}        # prompt_id -> (base url, handler(msg_type, data), 監視状態)
+ws_orphans = OrderedDict()  # 購読前に届いたメッセージ: prompt_id -> [(msg_type, data), ...]
+ws_status_listeners = {}    # base url -> [listener(url, data)]  ("status" メッセージ用)
+ws_executing = {}       # base url -> 実行中の prompt_id (prompt_id を持たないプレビューフレームの宛先)
+
+WS_BACKOFF_MIN = 1.0
+WS_BACKOFF_MAX = 30.0
+WS_ORPHAN_PROMPTS = 256
+WS_ORPHAN_MESSAGES = 64
+
+def ensure_ws_receiver(url):
+    with ws_lock:
+        receiver = ws_receivers.get(url)
+        if receiver is None or receiver.done():
+            receiver = cc.spawn(websocket_receiver(url))
+            ws_receivers[url] = receiver
+    return receiver
+
+def subscribe_prompt(prompt_id, url, handler, state):
+    with ws_lock:
+        ws_handlers[prompt_id] = (url, handler, state)
+        backlog = ws_orphans.pop(prompt_id, [])
+    for msg_type, data in backlog:      # queue_prompt と購読の間に届いた分を再生
+        handler(msg_type, data)
+
+def unsubscribe_prompt(prompt_id):
+    with ws_lock:
+        ws_handlers.pop(prompt_id, None)
+
+def take_prompt_state(prompt_id):
+    # 購読を外して prompt の監視状態を返す (既に完了・未購読なら None)
+    with ws_lock:
+        entry = ws_handlers.pop(prompt_id, None)
+        ws_orphans.pop(prompt_id, None)
+    cp.discard(prompt_id)
+    if entry is None:
+        return None
+    _, _, state = entry
+    with state["lock"]:
+        if state["done"]:
+            return None
+        state["done"] = True
+    return state
+
+def add_status_listener(url, listener):
+    with ws_lock:
+        ws_status_listeners.setdefault(url, []).append(listener)
+    ensure_ws_receiver(url)
+
+def remove_status_listener(url, listener):
+    with ws_lock:
+        listeners = ws_status_listeners.get(url, [])
+        if listener in listeners:
+            listeners.remove(listener)
+
+def watch_prompt(prompt_id, url):
+    state = {"lock": threading.Lock(), "done": False, "started": False, "outputs": {}}
+    ev.set_status(prompt_id, "queued")
+    ensure_ws_receiver(url)
+    subscribe_prompt(prompt_id, url, partial(handle_prompt_message, prompt_id, url, state), state)
+
+def complete_prompt(prompt_id, url, state, outputs=None, error=None):
+    with state["lock"]:
+        if state["done"]:
+            return
+        state["done"] = True
+    unsubscribe_prompt(prompt_id)
+    cp.discard(prompt_id)
+    if error is not None:
+        ev.set_status(prompt_id, "failed")
+        cm.mark(prompt_id, cm.FAILED)
+        ws_log(f"❌ Prompt {prompt_id} failed: {error}", echo=True, prompt_id=prompt_id)
+        ctm.fail_generation(prompt_id, error)
+    else:
+        ev.set_status(prompt_id, "finished", f"✅ Prompt {prompt_id} finished")
+        cm.mark(prompt_id, cm.OUTPUTS_KNOWN)
+        ctm.finish_generation(prompt_id, url, outputs)
+
+# --- キャンセル ---
+# 待機中の prompt は /queue の delete で取り除き、実行中のものは /interrupt で止める。
+# 購読・タスク状態もここで片付けるので、後から届くイベントは無視される。
+def cancel_prompts(prompt_ids):
+    by_url = {}
+    for prompt_id in prompt_ids:
+        url = ctm.get_task_url(prompt_id)
+        if url is None or ctm.is_done(prompt_id) or take_prompt_state(prompt_id) is None:
+            continue
+        by_url.setdefault(url, []).append((prompt_id, ctm.is_running(prompt_id)))
+        ev.set_status(prompt_id, "cancelled", f"🛑 Prompt {prompt_id} cancelled")
+        ctm.cancel_generation(prompt_id)
+
+    cancelled = []
+    for url, items in by_url.items():
+        client = get_client(url)
         try:
-            ws = websocket.WebSocket()
-            ws.connect(ws_url)
-            with ws_log_lock:
-                ws_logs.append("🔌 WebSocket connected.")
-#            print("🟢 WebSocket connected.")
+            cc.run_sync(client.delete_queue([prompt_id for prompt_id, _ in items]))
+            for prompt_id, running in items:
+                if running:
+                    # prompt_id 指定なので、既に次の prompt に移っていれば何もしない
+                    cc.run_sync(client.interrupt(prompt_id))
+        except Exception as e:
+            print(f"Error cancelling prompts on {url}: {e}")
+        cancelled.extend(prompt_id for prompt_id, _ in items)
+    return cancelled
 
-            while True:  # Listen for messages
-                msg_str = ws.recv()
-                if not msg_str:
-                    continue  # Handle empty message
+def cancel_prompt(prompt_id):
+    return bool(cancel_prompts([prompt_id]))
 
-                try:
-                    msg = json.loads(msg_str)
-                    msg_type = msg.get("type", "")
-                    data = msg.get("data", {})
-
-                    # progress_state で全ノード finished 判定
-                    if msg_type == "progress_state" and prompt_id is not None:
-                        nodes = data.get("nodes", {})
-                        states = [  node.get("state") == "finished"
-                                    for node in nodes.values()
-                                    if node.get("prompt_id") == prompt_id   ]
-                        all_finished = all(states)
-
-                    # 進捗ログ
-                        for node in nodes.values():
-                            if node.get("prompt_id") != prompt_id:
-                                continue
-                            value = node.get("value")
-                            max_val = node.get("max")
-                            if value is not None and max_val:
-                                percent = (value / max_val) * 100
-                                with ws_log_lock:
-                                    ws_logs.append(f"Node {node.get('node_id')} Progress: {percent:.1f}%")
-
-                        if all_finished:
-                            ctm.finish_generation(prompt_id, url)
-                            break
+def handle_prompt_message(prompt_id, url, state, msg_type, data):
+    if msg_type in ("execution_start", "executing", "progress_state") and not state.get("started"):
+        if msg_type != "executing" or data.get("node") is not None:
+            state["started"] = True
+            ctm.start_generation(prompt_id)
+            ev.set_status(prompt_id, "running")
+            cm.mark(prompt_id, cm.FIRST_EXECUTION)
+
+    if msg_type == "executed":
+        # 出力ノードの完了通知: ファイル名はここで確定する
+        output = data.get("output") or {}
+        if output.get("images"):
+            with state["lock"]:
+                state["outputs"][data.get("node")] = output
+
+    elif msg_type == "execution_success" or (msg_type == "executing" and data.get("node") is None):
+        with state["lock"]:
+            outputs = dict(state["outputs"])
+        complete_prompt(prompt_id, url, state, outputs)
+
+    elif msg_type in ("execution_error", "execution_interrupted"):
+        error = data.get("exception_message") or msg_type
+        complete_prompt(prompt_id, url, state, error=error)
 
+    elif msg_type == "progress_state":
+        # 進捗: 実行中ノードだけをイベントバスへ
+        for node in data.get("nodes", {}).values():
+            if node.get("prompt_id", prompt_id) != prompt_id or node.get("state") != "running":
+                continue
+            value = node.get("value")
+            max_val = node.get("max")
+            if value is not None and max_val:
+                record_progress(prompt_id, node.get("node_id"), value, max_val)
+
+    elif msg_type == "progress":
+        if data.get("value") is not None and data.get("max"):
+            record_progress(prompt_id, data.get("node"), data["value"], data["max"])
+
+def record_progress(prompt_id, node_id, value, max_val):
+    ev.update_progress(prompt_id, node_id, value, max_val)
+    cm.mark(prompt_id, cm.FIRST_PROGRESS)
+    if value >= max_val:
+        cm.mark(prompt_id, cm.SAMPLING_DONE)
+
+async def recheck_prompt(prompt_id, url, state):
+    # 切断中に完了通知を取りこぼした可能性がある prompt を /history で 1 回だけ確認
+    try:
+        history = await get_client(url).get_history(prompt_id)
+    except Exception as e:
+        print(f"❌ 履歴取得エラー: {e}")
+        return
+    entry = (history or {}).get(prompt_id)
+    if entry is not None:
+        apply_history_entry(prompt_id, url, state, entry)
+
+def apply_history_entry(prompt_id, url, state, entry):
+    status = entry.get("status", {})
+    if status.get("status_str") == "error":
+        complete_prompt(prompt_id, url, state, error="execution error (from /history)")
+    elif status.get("completed", True):
+        complete_prompt(prompt_id, url, state, entry.get("outputs", {}))
+
+def reconcile_prompts(url, prompt_ids):
+    # 再起動後の引き継ぎ: 購読済みの prompt を /queue と /history の一括取得 1 回ずつで突き合わせる
+    # (購読してから問い合わせるので、その間に完了しても取りこぼさない)
+    client = get_client(url)
+    try:
+        queue = cc.run_sync(client.get_queue()) or {}
+        history = cc.run_sync(client.get_history()) or {}
+    except Exception as e:
+        print(f"⚠️ failed to reconcile prompts with {url}: {e}")
+        return
+    running = {item[1] for item in queue.get("queue_running", [])}
+    pending = {item[1] for item in queue.get("queue_pending", [])}
+    for prompt_id in prompt_ids:
+        with ws_lock:
+            entry = ws_handlers.get(prompt_id)
+        if entry is None:
+            continue        # 問い合わせ中に WebSocket 経由で完了済み
+        _, _, state = entry
+        if prompt_id in history:
+            apply_history_entry(prompt_id, url, state, history[prompt_id])
+        elif prompt_id in running:
+            handle_prompt_message(prompt_id, url, state, "execution_start", {"prompt_id": prompt_id})
+        elif prompt_id not in pending:
+            complete_prompt(prompt_id, url, state, error="lost: not in the server queue or history")
+
+def recheck_subscribed(url):
+    with ws_lock:
+        subscribed = [(prompt_id, state) for prompt_id, (u, _, state) in ws_handlers.items() if u == url]
+    for prompt_id, state in subscribed:
+        asyncio.ensure_future(recheck_prompt(prompt_id, url, state))
+
+def dispatch_ws_message(url, msg):
+    msg_type = msg.get("type", "")
+    data = msg.get("data") or {}
+    if msg_type == "status":
+        with ws_lock:
+            listeners = list(ws_status_listeners.get(url, []))
+        for listener in listeners:
+            listener(url, data)
+        return
+    prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+    if prompt_id is None:
+        return
+    if msg_type == "execution_start" or (msg_type == "executing" and data.get("node") is not None):
+        ws_executing[url] = prompt_id
+    elif msg_type in ("execution_success", "execution_error", "execution_interrupted", "executing"):
+        if ws_executing.get(url) == prompt_id:
+            ws_executing.pop(url, None)
+    with ws_lock:
+        entry = ws_handlers.get(prompt_id)
+        if entry is None:
+            backlog = ws_orphans.setdefault(prompt_id, [])
+            ws_orphans.move_to_end(prompt_id)
+            if len(backlog) < WS_ORPHAN_MESSAGES:
+                backlog.append((msg_type, data))
+            while len(ws_orphans) > WS_ORPHAN_PROMPTS:
+                ws_orphans.popitem(last=False)
+            return
+    _, handler, _ = entry
+    handler(msg_type, data)
+
+def dispatch_ws_binary(url, data):
+    frame = cp.parse_frame(data)
+    if frame is None:
+        return
+    prompt_id = frame.prompt_id or ws_executing.get(url)
+    with ws_lock:
+        subscribed = prompt_id in ws_handlers
+    if subscribed:
+        cp.publish(prompt_id, frame.image, frame.mime)
+
+async def websocket_receiver(url):
+    client = get_client(url)
+    backoff = WS_BACKOFF_MIN
+    connected_once = False
+    while True:  # Keep trying to connect if connection is lost
+        ws = None
+        try:
+            ws = await client.websocket()
+            backoff = WS_BACKOFF_MIN
+            ws_log(f"🔌 WebSocket connected: {url}")
+            if connected_once:
+                recheck_subscribed(url)
+            connected_once = True
+
+            async for msg in ws:  # Listen for messages
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    try:
+                        dispatch_ws_binary(url, msg.data)
+                    except Exception as e:
+                        ws_log(f"⚠️ Error processing binary frame ({len(msg.data)} bytes): {e}", echo=True)
+                    continue
+                if msg.type != aiohttp.WSMsgType.TEXT or not msg.data:
+                    continue
+                msg_str = msg.data
+                try:
+                    dispatch_ws_message(url, json.loads(msg_str))
                 except json.JSONDecodeError:
-                    err = f"⚠️ Failed to decode JSON: {msg_str[:200]}..."
-                    with ws_log_lock:
-                        ws_logs.append(err)
-                    print(err)
+                    ws_log(f"⚠️ Failed to decode JSON: {msg_str[:200]}...", echo=True)
                 except Exception as e:
                     tb = traceback.format_exc()
-                    err = f"⚠️ Error processing message: {e}\nTraceback:\n{tb}\n - Msg: {msg_str[:200]}..."
-                    with ws_log_lock:
-                        ws_logs.append(err)
-                    print(err)
-
-        except websocket.WebSocketConnectionClosedException:
-            err = "🔌 WebSocket connection closed. Attempting to reconnect..."
-            with ws_log_lock:
-                ws_logs.append(err)
-            print(err)
-            time.sleep(5)
+                    ws_log(f"⚠️ Error processing message: {e}\nTraceback:\n{tb}\n - Msg: {msg_str[:200]}...", echo=True)
+
+            ws_log(f"🔌 WebSocket connection closed. Reconnecting in {backoff:.0f}s...", echo=True)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            err = f"⚠️ WebSocket general error: {e}. Attempting to reconnect..."
-            with ws_log_lock:
-                ws_logs.append(err)
-            print(err)
-            time.sleep(3)
+            ws_log(f"⚠️ WebSocket general error: {e}. Reconnecting in {backoff:.0f}s...", echo=True)
+        finally:
+            if ws is not None:
+                await ws.close()
 
-        if ctm.generation_is_finished(prompt_id):
-#            print(f"Monitored prompt {prompt_id} finished, exiting receiver thread.")
-            break
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, WS_BACKOFF_MAX)
 
-    # Ensure WebSocket is closed on exiting the outer loop
+
+def fetch_history_entry(prompt_id, url):
     try:
-        ws.close()
-        msg = "🔌 WebSocket connection explicitly closed."
-        with ws_log_lock:
-            ws_logs.append(msg)
-#        print(msg)
-    except Exception:
-        pass
+        history = cc.run_sync(get_client(url).get_history(prompt_id))
+    except Exception as e:
+        print(f"❌ 履歴取得エラー: {e}")
+        return None
+    return (history or {}).get(prompt_id)
 
+def output_dir_for(url):
+    return OUTPUT_DIRS.get(url, OUTPUT_DIR) if url else OUTPUT_DIR
 
-def get_image_paths(prompt_id, url):
-    while True:
-        time.sleep(1)
-        try:
-            ep_url = f"{url}/history/{prompt_id}"
-            resp = requests.get(ep_url)
-            resp.raise_for_status()
-            history = resp.json()
-        except Exception as e:
-            print(f"❌ 履歴取得エラー: {e}")
-            continue
+OUTPUT_FETCH = "auto"   # "local": OUTPUT_DIR を直接参照 / "view": 常に /view で取得 / "auto": 同じマシンのサーバーなら local
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
 
-        if not history:
-#            print(f"{prompt_id} is not in /history yet!")
-            continue
+def output_images(outputs):
+    # "executed" / /history の outputs から保存画像 (type=output) の参照を取り出す
+    refs = []
+    for node_id, node_output in outputs.items():
+        for img in node_output.get("images", []):
+            if img.get("filename") and img.get("type", "output") == "output":
+                refs.append({"filename": img["filename"], "subfolder": img.get("subfolder", ""), "type": "output"})
+    return refs
 
-        outputs = history[prompt_id].get("outputs", {})
-        image_paths = []
-        for node_id, node_output in outputs.items():
-            for img in node_output.get("images", []):
-                filename = img.get("filename")
-                subfolder = img.get("subfolder", "")
-                if filename:
-                    full_path = os.path.join(OUTPUT_DIR, subfolder, filename) if subfolder else os.path.join(OUTPUT_DIR, filename)
-#                    print(f"DEBUG: appending full_path={full_path}")
-                    image_paths.append(full_path)
-
-        if image_paths:
-            ctm.save_image_paths(prompt_id, image_paths)
-
-            saved_thread = threading.Thread(target=ctm.image_saved, args=(prompt_id,))
-            saved_thread.daemon = True
-            saved_thread.start()
-            break
-        else:
-            print("❌ image_pathsがありません")
-            continue
-    return
+def is_local_backend(url):
+    # OUTPUT_DIRS で出力先を指定したバックエンドか、このマシン上のサーバーだけを local とみなす
+    # (それ以外は既定の OUTPUT_DIR が存在しても別マシンのファイルではないので /view で取得する)
+    if not url or url in OUTPUT_DIRS:
+        return True
+    return urlsplit(url).hostname in LOCAL_HOSTS
+
+def uses_local_outputs(url):
+    if OUTPUT_FETCH == "auto":
+        return is_local_backend(url) and os.path.isdir(output_dir_for(url))
+    return OUTPUT_FETCH == "local"
+
+def resolve_output_paths(prompt_id, url, refs):
+    if uses_local_outputs(url):
+        output_dir = output_dir_for(url)
+        return [ci.local_path(output_dir, ref) for ref in refs]
+    return ci.download_outputs(url, prompt_id, refs)
+
+def get_output_images(prompt_id, url):
+    # WebSocket で出力を取りこぼした場合のみ使う、/history の単発取得
+    entry = fetch_history_entry(prompt_id, url)
+    if entry is None:
+        print(f"❌ {prompt_id} is not in /history")
+        return []
+    return output_images(entry.get("outputs", {}))
+
+def get_image_paths(prompt_id, url):
+    return resolve_output_paths(prompt_id, url, get_output_images(prompt_id, url))
@@ -0,0 +1,155 @@
+import json
+import time
+import comfy_api as capi
+import comfy_task_manager as ctm
+import comfy_scheduler as cs
+import workflow_template as wt
+
+# シード・CFG・ステップ・サンプラー・解像度・プロンプトのグリッドを遅延展開し、
+# サーバー側のキューに常に max_queued 件を積んだまま結果を完了順に返す。
+#
+#   jobs = expand_grid(base, preset=preset_axis(presets, ["euler_karras"]),
+#                      resolution=load_resolutions(RESO_PATH)[:3], seed=range(100))
+#   for result in run_batch(COMFYUI_URL, workflow, node_ids, jobs, max_queued=3):
+#       print(result["prompt_id"], result["paths"])
+
+JOB_TIMEOUT = 600.0     # 実行開始からこの秒数で終わらないジョブは取り消して失敗扱い (None で無制限)
+STALE_CHECK = 30.0      # 完了がこの秒数途切れたら /queue と /history で取りこぼしを突き合わせる
+
+def load_presets(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def load_resolutions(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def preset_axis(presets, names=None):
+    names = list(presets.keys()) if names is None else names
+    return [presets[name] for name in names]
+
+def expand_axis(name, value):
+    if name == "preset":            # samplerscheduler.json の 1 エントリ
+        return {"sampler_name": value["sampler"], "scheduler": value["scheduler"]}
+    if name == "resolution":        # {"width", "height"} / (w, h) / "WxH"
+        if isinstance(value, dict):
+            return {"width": value["width"], "height": value["height"]}
+        if isinstance(value, str):
+            value = value.lower().replace(" ", "").split("x")
+        w, h = value
+        return {"width": int(w), "height": int(h)}
+    if name == "prompt":            # (positive, negative) または positive のみ
+        if isinstance(value, str):
+            return {"positive_prompt": value}
+        return {"positive_prompt": value[0], "negative_prompt": value[1]}
+    return {name: value}
+
+def lazy_product(axes):
+    # itertools.product と違い軸を tuple 化しないので range(2**32) 等もそのまま使える
+    # (先頭以外の軸は list / range など再走査できるものにする)
+    if not axes:
+        yield ()
+        return
+    for value in axes[0]:
+        for rest in lazy_product(axes[1:]):
+            yield (value,) + rest
+
+def expand_grid(base, **axes):
+    # axes の直積を 1 件ずつ生成する (全件をメモリに展開しない)
+    names = list(axes.keys())
+    for combo in lazy_product([axes[name] for name in names]):
+        job = dict(base)
+        for name, value in zip(names, combo):
+            job.update(expand_axis(name, value))
+        yield job
+
+def make_result(prompt_id, job, status=None, error=None):
+    return {"prompt_id": prompt_id,
+            "job": job,
+            "paths": status[ctm.PATHS] if status else [],
+            "failed": bool(error) or bool(status and status[ctm.FAILED]),
+            "error": error or (status.get("error") if status else None)}
+
+def submit_job(base_url, workflow, node_ids, job, dispatcher=None):
+    if dispatcher is not None:
+        return dispatcher.generate_image(workflow, node_ids, **job)
+    return capi.generate_image_with_api(base_url, workflow, node_ids, **job), base_url
+
+def reconcile_stale(in_flight):
+    # WebSocket の取りこぼしで終わらないジョブを拾う (サーバーから消えていれば lost で失敗になる)
+    by_url = {}
+    for prompt_id in in_flight:
+        url = ctm.get_task_url(prompt_id)
+        if url is not None:
+            by_url.setdefault(url, []).append(prompt_id)
+    for url, prompt_ids in by_url.items():
+        capi.reconcile_prompts(url, prompt_ids)
+
+def run_batch(base_url, workflow, node_ids, jobs, max_queued=2, wait_timeout=1.0, dispatcher=None,
+              reorder_window=cs.REORDER_WINDOW, max_bypass=cs.MAX_BYPASS,
+              job_timeout=JOB_TIMEOUT, stale_check=STALE_CHECK):
+    # jobs の各要素は generate_image_with_api のキーワード引数一式
+    # dispatcher (comfy_dispatch.Dispatcher) を渡すと base_url の代わりに複数バックエンドへ振り分ける
+    # reorder_window 件の範囲で同じ checkpoint のジョブをまとめて投げる (1 以下で投入順のまま)
+    if reorder_window and reorder_window > 1:
+        jobs = cs.AffinityScheduler(jobs, reorder_window, max_bypass)
+    jobs = iter(jobs)
+    workflow = wt.compile_template(workflow, node_ids)     # ジョブごとの再ハッシュを避ける
+    in_flight = {}      # prompt_id -> job
+    deadlines = {}      # prompt_id -> 取り消す時刻 (time.monotonic)。サーバーで実行が始まってから設定する
+    results = []
+    exhausted = False
+    last_done = last_scan = time.monotonic()
+
+    while True:
+        # 呼び出し側に結果を返す前に補充し、キューが空にならないようにする
+        # 後処理の投入待ちが溜まっている間は補充しない (投げるものが無ければ少し待つ)
+        while not exhausted and len(in_flight) < max_queued:
+            if ctm.postprocess_backlogged(0 if in_flight else wait_timeout):
+                break
+            job = next(jobs, None)
+            if job is None:
+                exhausted = True
+                break
+            prompt_id, url = submit_job(base_url, workflow, node_ids, job, dispatcher)
+            if prompt_id is None:
+                results.append(make_result(None, job, error="failed to queue prompt"))
+                continue
+            ctm.init_task_status(prompt_id, url, params=job)
+            in_flight[prompt_id] = job
+
+        yield from results
+        results = []
+        if not in_flight:
+            if exhausted:
+                return
+            continue
+        done = ctm.wait_any_done(list(in_flight.keys()), wait_timeout)
+        now = time.monotonic()
+        for prompt_id in done:
+            deadlines.pop(prompt_id, None)
+            results.append(make_result(prompt_id, in_flight.pop(prompt_id), ctm.get_task(prompt_id)))
+            if dispatcher is not None:
+                dispatcher.forget(prompt_id)
+        if done:
+            last_done = now
+
+        if job_timeout is not None and now - last_scan >= wait_timeout:
+            # 期限はキュー待ちを含めず、実行中になったのを見つけた時点から数える
+            # (front=True の対話ジョブや checkpoint の初回読み込みで待たされただけのジョブは取り消さない)
+            last_scan = now
+            for prompt_id in in_flight:
+                if prompt_id not in deadlines and ctm.is_running(prompt_id):
+                    deadlines[prompt_id] = now + job_timeout
+            expired = [prompt_id for prompt_id, deadline in deadlines.items() if deadline <= now]
+            if expired:
+                capi.cancel_prompts(expired)
+            for prompt_id in expired:
+                del deadlines[prompt_id]
+                results.append(make_result(prompt_id, in_flight.pop(prompt_id), ctm.get_task(prompt_id),
+                                           error=f"timed out after {job_timeout}s running"))
+                if dispatcher is not None:
+                    dispatcher.forget(prompt_id)
+        if not done and stale_check is not None and now - last_done >= stale_check:
+            reconcile_stale(list(in_flight.keys()))
+            last_done = now
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import comfy_api as capi
+import comfy_client as cc
+import comfy_dispatch as cd
+import comfy_task_manager as ctm
+import comfy_batch as cb
+import comfy_metrics as cm
+import result_cache as rc
+import comfy_journal as cj
+import workflow_utils as wu
+
+# fake_comfy_server を子プロセスで起動し、generate_image_with_api → WebSocket 受信 →
+# 出力解決 → タスク管理までを 1〜500 並列で回して、クライアント側の
+# スループット・追加レイテンシ・スレッド数・RSS を測る。
+#
+#   python comfy_bench.py --concurrency 1,10,100,500 --latency 0.2 > bench_output.txt
+#
+# --backends 2 以上ではサーバーを複数起動して Dispatcher 経由で投げ、振り分け件数と
+# 「prompt を記録したバックエンドで実際に実行され、出力もそのディレクトリにあるか」を検証する。
+#
+#   python comfy_bench.py --backends 2 --concurrency 10
+
+WORKFLOW_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workflow_api.json")
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_comfy_server.py")
+
+BASE_JOB = {"positive_prompt": "benchmark", "negative_prompt": "", "seed": 0,
+            "width": 512, "height": 512, "steps": 20, "cfg": 7.0,
+            "sampler_name": "euler", "scheduler": "normal", "denoise": 1.0,
+            "model_name": "bench.safetensors", "stop_at_clip_layer": -2,
+            "filename_prefix": "bench"}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def read_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def start_server(port, output_dir, args):
+    cmd = [sys.executable, SERVER_PATH, "--port", str(port), "--output-dir", output_dir,
+           "--latency", str(args.latency), "--jitter", str(args.jitter), "--steps", str(args.steps),
+           "--workers", str(args.workers), "--drop-rate", str(args.drop_rate)]
+    proc = subprocess.Popen(cmd)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("fake server did not start")
+
+class Sampler:
+    # 実行中のスレッド数と RSS のピークを定期的に記録する
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_kb = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_rss_kb = max(self.peak_rss_kb, read_rss_kb())
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else float("nan")
+
+def client_overhead(prompt_id):
+    # 全体時間からサーバー側の実行時間 (first_execution → outputs_known) を除いた分
+    timeline = cm.get_timeline(prompt_id)
+    if timeline is None:
+        return None
+    phases = timeline["phases"]
+    if cm.FILE_READY not in phases:
+        return None
+    total = phases[cm.FILE_READY] - phases[cm.SUBMITTED]
+    server = phases.get(cm.OUTPUTS_KNOWN, phases[cm.FILE_READY]) - phases.get(cm.FIRST_EXECUTION, phases[cm.SUBMITTED])
+    return total - server
+
+def check_dispatch(dispatcher, results):
+    # 振り分け件数と、記録したバックエンド (= タスクの URL) と実際に実行したサーバーの食い違いを数える
+    histories = {url: cc.run_sync(capi.get_client(url).get_history()) or {} for url in dispatcher.backends}
+    split = {url: 0 for url in dispatcher.backends}
+    misattributed = 0
+    for result in results:
+        prompt_id = result["prompt_id"]
+        if prompt_id is None:
+            continue
+        url = ctm.get_task_url(prompt_id)
+        split[url] = split.get(url, 0) + 1
+        ran_on = [u for u, history in histories.items() if prompt_id in history]
+        output_dir = capi.OUTPUT_DIRS.get(url, "")
+        if ran_on != [url] or not all(path.startswith(output_dir + os.sep) for path in result["paths"]):
+            misattributed += 1
+    return split, misattributed
+
+def run_level(url, template, node_ids, concurrency, jobs_per_level, dispatcher=None):
+    ctm.clear_task_status()
+    jobs = cb.expand_grid(BASE_JOB, seed=range(jobs_per_level))
+    results = []
+    started = time.time()
+    with Sampler() as sampler:
+        for result in cb.run_batch(url, template, node_ids, jobs, max_queued=concurrency, dispatcher=dispatcher):
+            results.append(result)
+    elapsed = time.time() - started
+    overheads = [o for o in (client_overhead(r["prompt_id"]) for r in results if r["prompt_id"]) if o is not None]
+    row = {"concurrency": concurrency,
+           "jobs": len(results),
+           "failed": sum(1 for r in results if r["failed"]),
+           "seconds": round(elapsed, 3),
+           "throughput": round(len(results) / elapsed, 2) if elapsed else 0.0,
+           "overhead_p50_ms": round(percentile(overheads, 0.5) * 1000, 2),
+           "overhead_p95_ms": round(percentile(overheads, 0.95) * 1000, 2),
+           "overhead_p99_ms": round(percentile(overheads, 0.99) * 1000, 2),
+           "peak_threads": sampler.peak_threads,
+           "peak_rss_mb": round(sampler.peak_rss_kb / 1024, 1)}
+    if dispatcher is not None:
+        split, misattributed = check_dispatch(dispatcher, results)
+        row["split"] = list(split.values())
+        row["misattributed"] = misattributed
+    return row
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Client throughput benchmark against fake_comfy_server")
+    parser.add_argument("--concurrency", default="1,10,50,100,500", help="comma separated max_queued levels")
+    parser.add_argument("--jobs", type=int, default=0, help="jobs per level (default: 2 x concurrency, min 20)")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=0, help="server-side parallelism (default: concurrency)")
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--backends", type=int, default=1, help="number of fake servers behind a Dispatcher")
+    parser.add_argument("--json", default=None, help="also write results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="print per-job messages (API response, image saved)")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+    with open(WORKFLOW_PATH, "r") as f:
+        workflow = json.load(f)
+    node_ids = wu.find_node_ids_from_connections(workflow)
+
+    # ジョブごとの通知がベンチマークを支配しないよう抑止 (--verbose で表示)
+    capi.VERBOSE = args.verbose
+    rc.RESULT_CACHE_ENABLED = False      # 各レベルで同じシードを使うのでキャッシュは無効化
+    cj.JOURNAL_ENABLED = False
+
+    rows = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        capi.OUTPUT_DIR = output_dir
+        for concurrency in levels:
+            args_level = argparse.Namespace(**vars(args))
+            args_level.workers = args.workers or concurrency
+            procs = []
+            dispatcher = None
+            try:
+                backends = []
+                for i in range(max(args.backends, 1)):
+                    # バックエンドごとに出力先を分け、出力パスからも実行したサーバーが分かるようにする
+                    port = free_port()
+                    backend_dir = os.path.join(output_dir, f"backend{i}") if args.backends > 1 else output_dir
+                    os.makedirs(backend_dir, exist_ok=True)
+                    procs.append(start_server(port, backend_dir, args_level))
+                    backends.append({"url": f"http://127.0.0.1:{port}", "output_dir": backend_dir})
+                url = backends[0]["url"]
+                if args.backends > 1:
+                    dispatcher = cd.Dispatcher(backends).start()
+                jobs_per_level = args.jobs or max(2 * concurrency, 20)
+                row = run_level(url, workflow, node_ids, concurrency, jobs_per_level, dispatcher)
+            finally:
+                if dispatcher is not None:
+                    dispatcher.stop()
+                for proc in procs:
+                    stop_server(proc)
+            rows.append(row)
+            print(json.dumps(row), flush=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    # 振り分け検証: どのバックエンドも使われ、実行したサーバーの取り違えが無いこと
+    if args.backends > 1 and any(row["misattributed"] or not all(row["split"]) for row in rows):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import os
+import json
+import atexit
+import asyncio
+import threading
+import aiohttp
+
+# ComfyUI の HTTP / WebSocket API を 1 本のイベントループ上で扱う非同期クライアント。
+# サーバーごとに keep-alive の接続プール (aiohttp.TCPConnector) を共有するので、
+# 大量の prompt を投げても TCP の張り直しやスレッドが増えない。
+# 同期コードからは run_sync / spawn でバックグラウンドループに処理を投げる。
+
+POOL_LIMIT = 8              # サーバーあたりの最大同時接続数
+KEEPALIVE_TIMEOUT = 30      # 秒
+CONNECT_TIMEOUT = 10        # 秒
+WS_HEARTBEAT = 30           # 秒
+VIEW_CHUNK_SIZE = 64 * 1024
+
+class ComfyClient:
+    def __init__(self, base_url, client_id=None, pool_limit=POOL_LIMIT):
+        self.base_url = base_url.rstrip("/")
+        self.client_id = client_id
+        self.pool_limit = pool_limit
+        self._session = None
+
+    @property
+    def ws_url(self):
+        scheme, host_port = self.base_url.split("://", 1)
+        ws_scheme = "wss" if scheme == "https" else "ws"
+        query = f"?clientId={self.client_id}" if self.client_id else ""
+        return f"{ws_scheme}://{host_port}/ws{query}"
+
+    async def session(self):
+        # ClientSession はループ上で作る必要があるので遅延生成
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_limit, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request_json(self, method, path, **kwargs):
+        session = await self.session()
+        async with session.request(method, f"{self.base_url}{path}", **kwargs) as resp:
+            resp.raise_for_status()
+            if resp.content_type == "application/json":
+                return await resp.json()
+            text = await resp.text()
+            return json.loads(text) if text else None
+
+    # --- /prompt ---
+    async def queue_prompt(self, prompt_workflow, front=False, extra_data=None):
+        payload = {"prompt": prompt_workflow}
+        if self.client_id:
+            payload["client_id"] = self.client_id
+        if front:
+            payload["front"] = True
+        if extra_data:
+            payload["extra_data"] = extra_data
+        return await self.request_json("POST", "/prompt", json=payload)
+
+    # --- /history ---
+    async def get_history(self, prompt_id=None, max_items=None):
+        path = f"/history/{prompt_id}" if prompt_id else "/history"
+        params = {"max_items": max_items} if max_items else None
+        return await self.request_json("GET", path, params=params)
+
+    # --- /queue ---
+    async def get_queue(self):
+        return await self.request_json("GET", "/queue")
+
+    async def delete_queue(self, prompt_ids):
+        return await self.request_json("POST", "/queue", json={"delete": list(prompt_ids)})
+
+    async def clear_queue(self):
+        return await self.request_json("POST", "/queue", json={"clear": True})
+
+    # --- /interrupt ---
+    async def interrupt(self, prompt_id=None):
+        payload = {"prompt_id": prompt_id} if prompt_id else {}
+        return await self.request_json("POST", "/interrupt", json=payload)
+
+    # --- /view ---
+    async def iter_view(self, filename, subfolder="", type="output", chunk_size=VIEW_CHUNK_SIZE):
+        session = await self.session()
+        params = {"filename": filename, "subfolder": subfolder, "type": type}
+        async with session.get(f"{self.base_url}/view", params=params) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def view(self, filename, subfolder="", type="output"):
+        chunks = [chunk async for chunk in self.iter_view(filename, subfolder, type)]
+        return b"".join(chunks)
+
+    async def view_exists(self, filename, subfolder="", type="output"):
+        # 本文は読まずにステータスだけ確認する
+        session = await self.session()
+        params = {"filename": filename, "subfolder": subfolder, "type": type}
+        async with session.get(f"{self.base_url}/view", params=params) as resp:
+            return resp.status == 200
+
+    # --- /upload/image ---
+    async def upload_image(self, path, filename=None, subfolder="", type="input", overwrite=False):
+        # ファイルオブジェクトを渡すと aiohttp がチャンク単位で送る (全体をメモリに読まない)
+        session = await self.session()
+        with open(path, "rb") as f:
+            form = aiohttp.FormData()
+            form.add_field("image", f, filename=filename or os.path.basename(path),
+                           content_type="application/octet-stream")
+            form.add_field("type", type)
+            if subfolder:
+                form.add_field("subfolder", subfolder)
+            if overwrite:
+                form.add_field("overwrite", "true")
+            async with session.post(f"{self.base_url}/upload/image", data=form) as resp:
+                resp.raise_for_status()
+                return await resp.json()
+
+    # --- /ws ---
+    async def websocket(self):
+        session = await self.session()
+        return await session.ws_connect(self.ws_url, heartbeat=WS_HEARTBEAT, max_msg_size=0)
+
+
+# --- 同期コード向け: 共有イベントループとクライアントのキャッシュ ---
+_loop_lock = threading.Lock()
+_loop = None
+_loop_thread = None
+_clients = {}       # (base url, client_id) -> ComfyClient
+
+def get_loop():
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="comfy-client-loop")
+            _loop_thread.daemon = True
+            _loop_thread.start()
+    return _loop
+
+def in_loop_thread():
+    return _loop_thread is not None and threading.current_thread() is _loop_thread
+
+def spawn(coro):
+    # ループ上でタスクを起動し concurrent.futures.Future を返す
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+def run_sync(coro, timeout=None):
+    if in_loop_thread():
+        coro.close()
+        raise RuntimeError("run_sync() called from the client event loop; await the coroutine instead")
+    return spawn(coro).result(timeout)
+
+def get_client(base_url, client_id=None):
+    key = (base_url.rstrip("/"), client_id)
+    with _loop_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = ComfyClient(base_url, client_id)
+            _clients[key] = client
+    return client
+
+async def close_clients(clients):
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+def close_all(timeout=5):
+    # 終了時に接続プールを閉じる (未クローズ警告の抑止)
+    with _loop_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    if _loop is None or not clients:
+        return
+    try:
+        run_sync(close_clients(clients), timeout)
+    except Exception:
+        pass
+
+atexit.register(close_all)
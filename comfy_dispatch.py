@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import comfy_api as capi
+import comfy_client as cc
+import result_cache as rc
+
+# 複数の ComfyUI ワーカーに prompt を振り分けるディスパッチャ。
+# 各バックエンドのキュー深さを /queue の定期取得と WebSocket の "status" で追跡し、
+# 健全なバックエンドのうち最も空いているものへ投げる。
+#
+#   dispatcher = Dispatcher(["http://10.0.0.1:8188",
+#                            {"url": "http://10.0.0.2:8188", "output_dir": "/mnt/w2/output"}])
+#   dispatcher.start()
+#   prompt_id, url = dispatcher.generate_image(workflow, node_ids, **params)
+#   ctm.init_task_status(prompt_id, url)
+
+QUEUE_POLL_INTERVAL = 2.0   # 秒
+FAILURE_THRESHOLD = 3       # 連続失敗でバックエンドを unhealthy 扱いにする
+
+class Dispatcher:
+    def __init__(self, backends, poll_interval=QUEUE_POLL_INTERVAL):
+        self.lock = threading.Lock()
+        self.poll_interval = poll_interval
+        self.backends = {}          # url -> {"queue_remaining", "failures", "healthy", "submitted"}
+        self.prompt_backend = {}    # prompt_id -> url
+        self.poller = None
+        for backend in backends:
+            if isinstance(backend, dict):
+                url = backend["url"]
+                if backend.get("output_dir"):
+                    capi.OUTPUT_DIRS[url] = backend["output_dir"]
+            else:
+                url = backend
+            self.backends[url] = {"queue_remaining": 0, "failures": 0, "healthy": True, "submitted": 0}
+
+    def start(self):
+        for url in self.backends:
+            capi.add_status_listener(url, self.on_status)
+        if self.poller is None or self.poller.done():
+            self.poller = cc.spawn(self.poll_queues())
+        return self
+
+    def stop(self):
+        for url in self.backends:
+            capi.remove_status_listener(url, self.on_status)
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+
+    # --- キュー深さの追跡 ---
+    def on_status(self, url, data):
+        exec_info = (data.get("status") or {}).get("exec_info") or {}
+        remaining = exec_info.get("queue_remaining")
+        if remaining is None:
+            return
+        with self.lock:
+            backend = self.backends.get(url)
+            if backend is not None:
+                backend["queue_remaining"] = remaining
+                self.mark_ok(backend)
+
+    async def poll_queues(self):
+        while True:
+            await asyncio.gather(*(self.poll_queue(url) for url in self.backends))
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll_queue(self, url):
+        try:
+            queue = await capi.get_client(url).get_queue()
+        except Exception as e:
+            self.record_failure(url, e)
+            return
+        depth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        with self.lock:
+            backend = self.backends[url]
+            backend["queue_remaining"] = depth
+            self.mark_ok(backend)
+
+    def mark_ok(self, backend):
+        backend["failures"] = 0
+        backend["healthy"] = True
+
+    def record_failure(self, url, error):
+        with self.lock:
+            backend = self.backends[url]
+            backend["failures"] += 1
+            if backend["healthy"] and backend["failures"] >= FAILURE_THRESHOLD:
+                backend["healthy"] = False
+                print(f"⚠️ backend unhealthy: {url} ({error})")
+
+    # --- 振り分け ---
+    def pick_backend(self):
+        with self.lock:
+            candidates = [url for url, b in self.backends.items() if b["healthy"]] or list(self.backends)
+            url = min(candidates, key=lambda u: (self.backends[u]["queue_remaining"], self.backends[u]["submitted"]))
+            # 次の status が届くまでの間に同じバックエンドへ偏らないよう楽観的に加算
+            self.backends[url]["queue_remaining"] += 1
+            self.backends[url]["submitted"] += 1
+        return url
+
+    def generate_image(self, workflow_json, node_ids, **params):
+        url = self.pick_backend()
+        prompt_id = capi.generate_image_with_api(url, workflow_json, node_ids, **params)
+        if prompt_id is None:
+            with self.lock:
+                self.backends[url]["queue_remaining"] -= 1
+            self.record_failure(url, "failed to queue prompt")
+            return None, url
+        if rc.is_cached(prompt_id):
+            with self.lock:
+                self.backends[url]["queue_remaining"] -= 1     # サーバーには投げていない
+        with self.lock:
+            self.prompt_backend[prompt_id] = url
+        return prompt_id, url
+
+    def backend_for(self, prompt_id):
+        with self.lock:
+            return self.prompt_backend.get(prompt_id)
+
+    def forget(self, prompt_id):
+        with self.lock:
+            self.prompt_backend.pop(prompt_id, None)
+
+    def snapshot(self):
+        with self.lock:
+            return {url: dict(b) for url, b in self.backends.items()}
@@ -0,0 +1,136 @@
+import time
+import threading
+from collections import deque, namedtuple, OrderedDict
+
+# WebSocket 受信側から流す型付きイベントバス。
+# - イベントはサイズ上限付きの deque に保持 (連続生成でもメモリ一定)
+# - prompt ごとに進捗 (現在ノード・step/max・ETA) を集約
+# - 変化のたびに version を進めるので、UI のタイマーは version が変わった時だけ再描画すればよい
+
+EVENT_BUFFER = 500
+LOG_LINES = 100
+MAX_TRACKED_PROMPTS = 64
+
+LOG = "log"
+PROGRESS = "progress"
+STATUS = "status"           # queued / running / finished / failed など
+
+Event = namedtuple("Event", ["ts", "kind", "prompt_id", "message", "data"])
+
+bus_lock = threading.Lock()
+bus_cond = threading.Condition(bus_lock)
+events = deque(maxlen=EVENT_BUFFER)
+progress = OrderedDict()    # prompt_id -> 集約済み進捗 (古い順に破棄)
+version = 0
+rendered = {"version": -1, "text": ""}
+
+def bump_locked():
+    global version
+    version += 1
+    bus_cond.notify_all()
+
+def publish(kind, message, prompt_id=None, **data):
+    with bus_lock:
+        events.append(Event(time.time(), kind, prompt_id, message, data))
+        bump_locked()
+
+def log(message, prompt_id=None):
+    publish(LOG, message, prompt_id)
+
+def update_progress(prompt_id, node_id, value, max_value):
+    now = time.time()
+    with bus_lock:
+        state = progress.get(prompt_id)
+        if state is None:
+            state = {"status": "running", "node": None, "value": 0, "max": 0,
+                     "node_started": now, "start_value": 0, "eta": None, "updated": now}
+            progress[prompt_id] = state
+            while len(progress) > MAX_TRACKED_PROMPTS:
+                progress.popitem(last=False)
+        if state["node"] == node_id and state["value"] == value and state["max"] == max_value:
+            return      # "progress" と "progress_state" の重複通知
+        if state["node"] != node_id or value < state["value"]:
+            # ノードが変わったら速度計測をやり直す
+            state.update(node=node_id, node_started=now, start_value=value)
+        state.update(value=value, max=max_value, updated=now, status="running")
+        done = value - state["start_value"]
+        elapsed = now - state["node_started"]
+        state["eta"] = (max_value - value) * elapsed / done if done > 0 and elapsed > 0 else None
+        percent = (value / max_value) * 100 if max_value else 0.0
+        events.append(Event(now, PROGRESS, prompt_id, f"Node {node_id} Progress: {percent:.1f}%",
+                            {"node": node_id, "value": value, "max": max_value}))
+        bump_locked()
+
+def set_status(prompt_id, status, message=None):
+    now = time.time()
+    with bus_lock:
+        state = progress.get(prompt_id)
+        if state is None:
+            state = {"node": None, "value": 0, "max": 0, "node_started": now,
+                     "start_value": 0, "eta": None}
+            progress[prompt_id] = state
+            while len(progress) > MAX_TRACKED_PROMPTS:
+                progress.popitem(last=False)
+        state.update(status=status, updated=now)
+        if status != "running":
+            state["eta"] = None
+        progress.move_to_end(prompt_id)
+        if message:
+            events.append(Event(now, STATUS, prompt_id, message, {"status": status}))
+        bump_locked()
+
+def get_version():
+    return version
+
+def wait_for_change(last_version, timeout=None):
+    with bus_cond:
+        bus_cond.wait_for(lambda: version != last_version, timeout)
+        return version
+
+def get_progress(prompt_id):
+    with bus_lock:
+        state = progress.get(prompt_id)
+        return dict(state) if state else None
+
+def get_latest_progress():
+    with bus_lock:
+        if not progress:
+            return None, None
+        prompt_id = next(reversed(progress))
+        return prompt_id, dict(progress[prompt_id])
+
+def format_progress(prompt_id, state):
+    if state is None:
+        return ""
+    text = f"{prompt_id[:8]} {state['status']}"
+    if state["node"] is not None and state["max"]:
+        text += f" | node {state['node']} {state['value']}/{state['max']}"
+    if state["eta"] is not None:
+        text += f" | ETA {state['eta']:.1f}s"
+    return text
+
+def get_progress_text():
+    return format_progress(*get_latest_progress())
+
+def get_log_text(lines=LOG_LINES):
+    # version が変わっていなければ前回の文字列をそのまま返す
+    with bus_lock:
+        if rendered["version"] == version:
+            return rendered["text"]
+        recent = list(events)[-lines:]
+        rendered["text"] = "\n".join(event.message for event in recent)
+        rendered["version"] = version
+        return rendered["text"]
+
+def get_text_if_changed(last_version):
+    # UI タイマー用: 前回から変化が無ければ (None, None, version) を返す
+    current = version
+    if current == last_version:
+        return None, None, current
+    return get_log_text(), get_progress_text(), current
+
+def clear():
+    with bus_lock:
+        events.clear()
+        progress.clear()
+        bump_locked()
@@ -0,0 +1,141 @@
+import io
+import os
+import asyncio
+import threading
+from collections import OrderedDict
+from PIL import Image
+import comfy_client as cc
+import thumbnails as th
+
+# 出力画像を /view (filename / subfolder / type) からチャンク単位で取得し、
+# 原寸画像とサムネイルをサイズ上限付きの LRU キャッシュに置く。
+# キーは (prompt_id, filename)。UI の再描画はディスクを読まずメモリから返せる。
+
+DOWNLOAD_DIR = "/content/comfy_api_outputs"     # リモートバックエンドの出力の保存先
+FULL_CACHE_BYTES = 256 * 1024 * 1024
+THUMB_CACHE_BYTES = 32 * 1024 * 1024
+
+class ImageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items = OrderedDict()      # key -> bytes
+        self.total_bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self.items[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def discard_prompt(self, prompt_id):
+        with self.lock:
+            for key in [k for k in self.items if k[0] == prompt_id]:
+                self.total_bytes -= len(self.items.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.total_bytes = 0
+
+full_cache = ImageCache(FULL_CACHE_BYTES)
+thumb_cache = ImageCache(THUMB_CACHE_BYTES)
+
+def cache_key(prompt_id, ref):
+    return (prompt_id, ref["filename"])
+
+def local_path(output_dir, ref):
+    subfolder = ref.get("subfolder", "")
+    return os.path.join(output_dir, subfolder, ref["filename"]) if subfolder else os.path.join(output_dir, ref["filename"])
+
+def open_part(dest_path):
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    return open(dest_path + ".part", "wb")
+
+def remove_part(dest_path):
+    try:
+        os.remove(dest_path + ".part")
+    except OSError:
+        pass
+
+async def stream_view(url, ref, dest_path=None, keep_bytes=True):
+    # dest_path があれば .part に書いてから置き換える。keep_bytes なら中身も返す
+    # 共有イベントループは全バックエンドの WebSocket 受信も担うので、ファイル操作はスレッドプールで行う
+    # 失敗した場合は .part を消す
+    client = cc.get_client(url)
+    loop = asyncio.get_running_loop()
+    chunks = [] if keep_bytes else None
+    f = None
+    try:
+        if dest_path is not None:
+            f = await loop.run_in_executor(None, open_part, dest_path)
+        async for chunk in client.iter_view(ref["filename"], ref.get("subfolder", ""), ref.get("type", "output")):
+            if f is not None:
+                await loop.run_in_executor(None, f.write, chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+        if f is not None:
+            await loop.run_in_executor(None, f.close)
+            await loop.run_in_executor(None, os.replace, dest_path + ".part", dest_path)
+    except BaseException:
+        if f is not None:
+            f.close()
+            await asyncio.shield(loop.run_in_executor(None, remove_part, dest_path))
+        raise
+    return b"".join(chunks) if chunks is not None else None
+
+def backend_dir(url):
+    # バックエンドごとに連番ファイル名が衝突しないよう host_port で分ける
+    return url.split("://", 1)[-1].rstrip("/").replace(":", "_").replace("/", "_")
+
+def download_outputs(url, prompt_id, refs, dest_dir=None):
+    # リモートの出力をローカルに保存し、原寸画像をキャッシュにも載せる
+    dest_dir = os.path.join(dest_dir or DOWNLOAD_DIR, backend_dir(url))
+    paths = []
+    for ref in refs:
+        path = local_path(dest_dir, ref)
+        data = cc.run_sync(stream_view(url, ref, path))
+        full_cache.put(cache_key(prompt_id, ref), data)
+        paths.append(path)
+    return paths
+
+def get_image_bytes(url, prompt_id, ref, path=None):
+    key = cache_key(prompt_id, ref)
+    data = full_cache.get(key)
+    if data is not None:
+        return data
+    if path is not None and os.path.exists(path):
+        with open(path, "rb") as f:
+            data = f.read()
+    else:
+        data = cc.run_sync(stream_view(url, ref))
+    full_cache.put(key, data)
+    return data
+
+def get_image(url, prompt_id, ref, path=None):
+    return Image.open(io.BytesIO(get_image_bytes(url, prompt_id, ref, path)))
+
+def get_thumbnail_bytes(url, prompt_id, ref, path=None):
+    key = cache_key(prompt_id, ref)
+    data = thumb_cache.get(key)
+    if data is None:
+        data = th.encode_thumbnail(get_image_bytes(url, prompt_id, ref, path))
+        thumb_cache.put(key, data)
+    return data
+
+def get_thumbnail(url, prompt_id, ref, path=None):
+    return Image.open(io.BytesIO(get_thumbnail_bytes(url, prompt_id, ref, path)))
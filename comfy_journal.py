@@ -0,0 +1,160 @@
+import json
+import os
+import time
+import fcntl
+import sqlite3
+import threading
+
+# 投入したジョブの追記型ジャーナル (SQLite, WAL)。
+# カーネルや Gradio が落ちても、再起動後に comfy_task_manager.recover_tasks() が
+# 終わっていない prompt を読み出し、/queue と /history で突き合わせて追跡を再開する (再投入はしない)。
+# WebSocket の通知は投入時の client_id 宛てに届くので、client_id もここに保存して使い回す。
+# 同じ clientId で繋ぎ直すと ComfyUI は前のソケットを捨てるため、client_id はプロセスごとに別にする。
+# 保存済みの client_id はロックファイル (flock) を持つ生きたプロセスが居ない場合だけ引き継ぐ
+# (プロセスが落ちればロックは OS が外す)。
+
+JOURNAL_PATH = "/content/comfy_journal.sqlite"
+JOURNAL_ENABLED = True
+RETENTION = 7 * 24 * 3600       # 終了した prompt の記録を残す秒数 (compact で削除)
+
+SUBMITTED = "submitted"
+SAVED = "saved"
+FAILED = "failed"
+TERMINAL_KINDS = (SAVED, FAILED)
+
+journal_lock = threading.Lock()
+state = {"conn": None, "path": None, "client_id": None, "lease": None}   # lease: client_id のロックファイル
+
+def connect_locked():
+    if state["conn"] is None or state["path"] != JOURNAL_PATH:
+        if state["conn"] is not None:
+            state["conn"].close()
+        os.makedirs(os.path.dirname(JOURNAL_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(JOURNAL_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                            seq INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL,
+                            prompt_id TEXT NOT NULL, kind TEXT NOT NULL, url TEXT, data TEXT)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS events_prompt ON events (prompt_id, kind)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS clients (client_id TEXT PRIMARY KEY, last_used REAL NOT NULL)")
+        # 旧形式 (全プロセス共通の client_id を meta に 1 つ) からの移行
+        conn.execute("INSERT OR IGNORE INTO clients (client_id, last_used) "
+                     "SELECT value, 0 FROM meta WHERE key = 'client_id'")
+        conn.commit()
+        state["conn"], state["path"] = conn, JOURNAL_PATH
+    return state["conn"]
+
+def append(prompt_id, kind, url=None, **data):
+    if not JOURNAL_ENABLED:
+        return
+    try:
+        with journal_lock:
+            conn = connect_locked()
+            conn.execute("INSERT INTO events (ts, prompt_id, kind, url, data) VALUES (?, ?, ?, ?, ?)",
+                         (time.time(), prompt_id, kind, url, json.dumps(data, ensure_ascii=False, default=str)))
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️ journal write failed ({kind} {prompt_id}): {e}")
+
+def record_submitted(prompt_id, url, params=None, priority=None, client_id=None):
+    append(prompt_id, SUBMITTED, url, params=params, priority=priority, client_id=client_id)
+
+def record_finished(prompt_id, kind, **data):
+    append(prompt_id, kind, **data)
+
+def open_jobs(client_id=None):
+    # 投入済みで保存・失敗の記録が無い prompt: [{"prompt_id", "url", "submitted_at", "params", "priority"}]
+    # client_id を渡すとその client_id で投げたものだけ (他の生きたプロセスの prompt は拾わない)
+    if not JOURNAL_ENABLED:
+        return []
+    try:
+        with journal_lock:
+            rows = open_rows_locked(connect_locked())
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️ journal read failed: {e}")
+        return []
+    jobs = []
+    for prompt_id, url, ts, data, owner in rows:
+        if client_id is not None and owner != client_id:
+            continue
+        jobs.append({"prompt_id": prompt_id, "url": url, "submitted_at": ts,
+                     "params": data.get("params"), "priority": data.get("priority")})
+    return jobs
+
+def open_rows_locked(conn):
+    # [(prompt_id, url, ts, data, 投げた client_id)]
+    rows = conn.execute(
+        "SELECT s.prompt_id, s.url, s.ts, s.data FROM events s WHERE s.kind = ? AND NOT EXISTS "
+        "(SELECT 1 FROM events e WHERE e.prompt_id = s.prompt_id AND e.kind IN (?, ?)) ORDER BY s.seq",
+        (SUBMITTED,) + TERMINAL_KINDS).fetchall()
+    legacy = conn.execute("SELECT value FROM meta WHERE key = 'client_id'").fetchone()
+    legacy_id = legacy[0] if legacy else None     # client_id を記録していない旧形式の行の持ち主
+    result = []
+    for prompt_id, url, ts, data in rows:
+        data = json.loads(data) if data else {}
+        result.append((prompt_id, url, ts, data, data.get("client_id") or legacy_id))
+    return result
+
+def lease_path(client_id):
+    return f"{JOURNAL_PATH}.{client_id}.lock"
+
+def try_lease(client_id):
+    # 他の生きたプロセスが使っていなければロックを取ってファイルを返す (取れなければ None)
+    try:
+        f = open(lease_path(client_id), "a")
+    except OSError:
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def acquire_client_id(default):
+    # 使われていない保存済みの client_id (終わっていない prompt を持つもの優先、次に最後に使われた順) を
+    # 引き継ぎ、無ければ default を登録して返す。
+    # ロックはプロセスが終わるまで持ち続ける (comfy_api を reload しても同じ client_id を返す)
+    if not JOURNAL_ENABLED:
+        return default
+    try:
+        with journal_lock:
+            if state["client_id"] is not None:
+                return state["client_id"]
+            conn = connect_locked()
+            owners = {row[4] for row in open_rows_locked(conn)}
+            known = [row[0] for row in conn.execute("SELECT client_id FROM clients ORDER BY last_used DESC")]
+            known.sort(key=lambda candidate: candidate not in owners)
+            client_id, lease = default, None
+            for candidate in known:
+                lease = try_lease(candidate)
+                if lease is not None:
+                    client_id = candidate
+                    break
+            else:
+                lease = try_lease(default)
+            conn.execute("INSERT OR REPLACE INTO clients (client_id, last_used) VALUES (?, ?)", (client_id, time.time()))
+            conn.commit()
+            state["client_id"], state["lease"] = client_id, lease
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️ journal read failed: {e}")
+        return default
+    return client_id
+
+def compact(retention=RETENTION):
+    # 終了から retention 秒以上経った prompt の記録を消す
+    if not JOURNAL_ENABLED:
+        return 0
+    cutoff = time.time() - retention
+    try:
+        with journal_lock:
+            conn = connect_locked()
+            cur = conn.execute("DELETE FROM events WHERE prompt_id IN (SELECT prompt_id FROM events "
+                               "WHERE kind IN (?, ?) AND ts < ?)", TERMINAL_KINDS + (cutoff,))
+            conn.commit()
+            return cur.rowcount
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️ journal compact failed: {e}")
+        return 0
@@ -1,25 +1,189 @@
+import os
+import time
 import threading
+from collections import deque
 
-log_lock = threading.Lock()       # ファイル書き込み用のロック
+FLUSH_INTERVAL = 1.0            # 秒: この間隔ごとにバッファをファイルへ書き出す
+FLUSH_BYTES = 64 * 1024         # バッファがこのサイズを超えたら即書き出す
+MAX_LOG_BYTES = None            # 例: 50 * 1024 * 1024 でサイズローテーション有効
+BACKUP_COUNT = 3
+TAIL_LINES = 100
+TAIL_BLOCK = 64 * 1024
+
+log_lock = threading.Lock()       # writers / tails の登録用のロック
+
+
+class LogWriter:
+    # 複数のパイプ (stdout / stderr) から同じファイルへ書くためのバッファ付きライター
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES,
+                 max_bytes=MAX_LOG_BYTES, backup_count=BACKUP_COUNT):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered = 0
+        self.file = open(path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+        flusher = threading.Thread(target=self.flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def write_line(self, line):
+        with self.lock:
+            self.buffer.append(line + "\n")
+            self.buffered += len(line) + 1
+            if self.buffered >= self.flush_bytes:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if not self.buffer:
+            return
+        data = "".join(self.buffer)
+        self.buffer.clear()
+        self.buffered = 0
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data.encode("utf-8"))
+        if self.max_bytes and self.size >= self.max_bytes:
+            self.rotate_locked()
+
+    def rotate_locked(self):
+        # path -> path.1 -> path.2 ... (backup_count を超えた分は削除)
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.size = 0
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ ログの書き込みに失敗しました: {e}")
+
+writers = {}        # log file path -> LogWriter
+
+def get_writer(log_file_path):
+    with log_lock:
+        writer = writers.get(log_file_path)
+        if writer is None:
+            writer = LogWriter(log_file_path)
+            writers[log_file_path] = writer
+    return writer
 
 # ログをリアルタイムで読み取り、ファイルに書き込む関数
 def read_logs_and_write_file(pipe, log_file_path, prefix):
-    with open(log_file_path, "a", encoding="utf-8") as f:
-        for line in iter(pipe.readline, b''):
-            decoded_line = line.decode('utf-8', errors='ignore').strip()
-            tagged_line = f"[{prefix}] {decoded_line}"
-            # print(tagged_line)    #debug時、即時コメント解除
-
-            with log_lock:
-                f.write(tagged_line + "\n")
-                f.flush() # ファイルバッファをフラッシュ
+    writer = get_writer(log_file_path)
+    for line in iter(pipe.readline, b''):
+        decoded_line = line.decode('utf-8', errors='ignore').strip()
+        tagged_line = f"[{prefix}] {decoded_line}"
+        # print(tagged_line)    #debug時、即時コメント解除
+        writer.write_line(tagged_line)
+    writer.flush()
     pipe.close()
 
+
+class LogTail:
+    # 前回の読み取り位置 (バイトオフセット) から差分だけ読み、末尾 N 行をリングバッファに保持する
+    def __init__(self, path, max_lines=TAIL_LINES):
+        self.path = path
+        self.lines = deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+        self.inode = None
+        self.offset = 0
+        self.partial = b""
+        self.version = 0        # 内容が変わるたびに増える
+
+    def poll(self):
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                return self.version
+            with open(self.path, "rb") as f:
+                if st.st_ino != self.inode or st.st_size < self.offset:
+                    # 初回・ローテーション・切り詰め: 末尾から読み直す
+                    self.inode = st.st_ino
+                    self.lines.clear()
+                    self.partial = b""
+                    self.offset = self.find_tail_start(f, st.st_size)
+                    self.version += 1
+                if st.st_size > self.offset:
+                    f.seek(self.offset)
+                    data = f.read(st.st_size - self.offset)
+                    self.offset += len(data)
+                    self.append(data)
+            return self.version
+
+    def find_tail_start(self, f, size):
+        # 末尾から TAIL_BLOCK ずつ遡って max_lines 行分の開始位置を探す
+        pos = size
+        newlines = 0
+        while pos > 0:
+            step = min(TAIL_BLOCK, pos)
+            pos -= step
+            f.seek(pos)
+            block = f.read(step)
+            newlines += block.count(b"\n")
+            if newlines > self.lines.maxlen:
+                # ブロック内で余分な行を先頭から飛ばす
+                idx = -1
+                for _ in range(newlines - self.lines.maxlen):
+                    idx = block.index(b"\n", idx + 1)
+                return pos + idx + 1
+        return 0
+
+    def append(self, data):
+        data = self.partial + data
+        *complete, self.partial = data.split(b"\n")
+        if complete:
+            self.lines.extend(line.decode("utf-8", errors="ignore") + "\n" for line in complete)
+            self.version += 1
+
+    def text(self):
+        with self.lock:
+            return "".join(self.lines)
+
+tails = {}          # log file path -> LogTail
+
+def get_tail(path, max_lines=TAIL_LINES):
+    with log_lock:
+        tail = tails.get(path)
+        if tail is None:
+            tail = LogTail(path, max_lines)
+            tails[path] = tail
+    return tail
+
 def get_log_text(path: str):
     try:
-        with log_lock:
-            with open(path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-        return "".join(lines[-100:])  # 最新100行だけ
+        tail = get_tail(path)
+        tail.poll()
+        return tail.text()      # 最新100行だけ
+    except Exception as e:
+        return f"⚠️ ログの読み取りに失敗しました: {e}"
+
+def get_log_text_if_changed(path, last_version):
+    # UI タイマー用: 前回から変化が無ければ text に None を返す
+    try:
+        tail = get_tail(path)
+        version = tail.poll()
     except Exception as e:
-        return f"⚠️ ログの読み取りに失敗しました: {e}"
\ No newline at end of file
+        return f"⚠️ ログの読み取りに失敗しました: {e}", -1
+    if version == last_version:
+        return None, version
+    return tail.text(), version
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import threading
+from collections import deque, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# prompt ごとのレイテンシのタイムライン。
+# 各フェーズの初回到達時刻を記録し、フェーズ間の所要時間を
+# (フェーズ, checkpoint, resolution) ごとの直近サンプルとして集計する。
+# 出力: Prometheus テキスト (render_prometheus / write_prometheus / start_metrics_server)
+#       と JSONL トレース (enable_trace)。
+
+SUBMITTED = "submitted"             # /prompt POST 開始
+ACCEPTED = "accepted"               # /prompt 応答 (prompt_id 確定)
+FIRST_EXECUTION = "first_execution" # サーバー側で実行開始
+FIRST_PROGRESS = "first_progress"   # 最初の進捗 (サンプリング開始)
+SAMPLING_DONE = "sampling_done"     # 進捗が max に到達
+OUTPUTS_KNOWN = "outputs_known"     # 完了通知・出力ファイル名が判明
+FILE_READY = "file_ready"           # ファイルが読める状態
+DISPLAYED = "displayed"             # UI / ノートブックで表示
+FAILED = "failed"
+
+PHASES = (SUBMITTED, ACCEPTED, FIRST_EXECUTION, FIRST_PROGRESS, SAMPLING_DONE,
+          OUTPUTS_KNOWN, FILE_READY, DISPLAYED, FAILED)
+
+SAMPLES_PER_SERIES = 1000
+MAX_TIMELINES = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+METRICS_PORT = 9464
+METRICS_HOST = "127.0.0.1"          # 外部から scrape させる場合だけ "0.0.0.0" などを明示する
+
+metrics_lock = threading.Lock()
+timelines = OrderedDict()   # prompt_id -> {"labels": {...}, "phases": {phase: ts}, "last": ts}
+series = {}                 # (metric, phase, checkpoint, resolution) -> deque of seconds
+totals = {}                 # 同キー -> [count, sum] (サンプル上限に関係なく累積)
+trace = {"path": None, "file": None}
+
+def start(prompt_id, submitted_at, checkpoint="", resolution=""):
+    with metrics_lock:
+        timelines[prompt_id] = {"labels": {"checkpoint": str(checkpoint), "resolution": str(resolution)},
+                                "phases": {SUBMITTED: submitted_at}, "last": submitted_at}
+        while len(timelines) > MAX_TIMELINES:
+            timelines.popitem(last=False)
+        write_trace_locked(prompt_id, SUBMITTED, submitted_at)
+
+def mark(prompt_id, phase, ts=None):
+    # 各フェーズは初回のみ記録する
+    ts = time.time() if ts is None else ts
+    with metrics_lock:
+        timeline = timelines.get(prompt_id)
+        if timeline is None or phase in timeline["phases"]:
+            return
+        timeline["phases"][phase] = ts
+        labels = timeline["labels"]
+        since_prev = max(ts - timeline["last"], 0.0)
+        since_submit = max(ts - timeline["phases"][SUBMITTED], 0.0)
+        timeline["last"] = ts
+        for metric, value in (("phase", since_prev), ("elapsed", since_submit)):
+            observe_locked((metric, phase, "", ""), value)
+            observe_locked((metric, phase, labels["checkpoint"], labels["resolution"]), value)
+        write_trace_locked(prompt_id, phase, ts)
+
+def observe_locked(key, value):
+    samples = series.get(key)
+    if samples is None:
+        samples = series[key] = deque(maxlen=SAMPLES_PER_SERIES)
+        totals[key] = [0, 0.0]
+    samples.append(value)
+    totals[key][0] += 1
+    totals[key][1] += value
+
+def get_timeline(prompt_id):
+    with metrics_lock:
+        timeline = timelines.get(prompt_id)
+        return {"labels": dict(timeline["labels"]), "phases": dict(timeline["phases"])} if timeline else None
+
+def quantile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    idx = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+def summarize():
+    # {(metric, phase, checkpoint, resolution): {"p50", "p95", "p99", "count", "sum"}}
+    with metrics_lock:
+        snapshot = {key: (sorted(samples), list(totals[key])) for key, samples in series.items()}
+    result = {}
+    for key, (values, (count, total)) in snapshot.items():
+        stats = {f"p{int(q * 100)}": quantile(values, q) for q in QUANTILES}
+        stats.update(count=count, sum=total)
+        result[key] = stats
+    return result
+
+def render_prometheus():
+    lines = []
+    names = {"phase": "comfy_phase_seconds", "elapsed": "comfy_elapsed_seconds"}
+    helps = {"phase": "Seconds from the previous recorded phase to this phase",
+             "elapsed": "Seconds from prompt submission to this phase"}
+    summary = summarize()
+    for metric in ("phase", "elapsed"):
+        name = names[metric]
+        lines.append(f"# HELP {name} {helps[metric]}")
+        lines.append(f"# TYPE {name} summary")
+        for (m, phase, checkpoint, resolution), stats in sorted(summary.items()):
+            if m != metric:
+                continue
+            labels = f'phase="{phase}"'
+            if checkpoint or resolution:
+                labels += f',checkpoint="{escape_label(checkpoint)}",resolution="{escape_label(resolution)}"'
+            for q in QUANTILES:
+                lines.append(f'{name}{{{labels},quantile="{q}"}} {stats[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f"{name}_sum{{{labels}}} {stats['sum']:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {stats['count']}")
+    return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def write_prometheus(path):
+    # node_exporter の textfile collector 等向け (書き換えはアトミック)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+# --- JSONL トレース ---
+def enable_trace(path):
+    with metrics_lock:
+        if trace["file"] is not None:
+            trace["file"].close()
+        trace["path"] = path
+        trace["file"] = open(path, "a", encoding="utf-8") if path else None
+
+def write_trace_locked(prompt_id, phase, ts):
+    f = trace["file"]
+    if f is None:
+        return
+    record = {"ts": ts, "prompt_id": prompt_id, "phase": phase}
+    record.update(timelines[prompt_id]["labels"])
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    if phase in (FILE_READY, DISPLAYED, FAILED):
+        f.flush()
+
+# --- /metrics エンドポイント ---
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,186 @@
+import os
+import json
+import queue
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import thumbnails as th
+
+# 保存済み画像の後処理 (サムネイル・WebP/JPEG 変換・パラメータ JSON の埋め込み・知覚ハッシュ)。
+# 画像 1 枚を 1 ジョブとしてプロセスプールで実行し、結果はコールバックで逐次返す。
+# プールに投入中のジョブ数は MAX_PENDING まで。超えた分は submit ではなく投入スレッドが待つ
+# (submit は完了処理スレッドから呼ばれるので、後処理の詰まりで他の prompt の完了を止めない)。
+# 投入待ちは MAX_BACKLOG 件まで。半分を超えたら is_backlogged() が True になり、
+# run_batch は補充を止める (生産側へのバックプレッシャー)。それでも溢れた分はエラーで返す。
+# 子プロセスは spawn で起動し、このモジュールだけを import する (WebSocket 等は持ち込まない)。
+
+THUMBNAIL = "thumbnail"
+WEBP = "webp"
+JPEG = "jpeg"
+PARAMS = "params"
+PHASH = "phash"
+ALL_STEPS = (PARAMS, PHASH, THUMBNAIL, WEBP, JPEG)     # この順に実行する (埋め込みを先に)
+
+STEPS = ()                  # 有効な後処理 (空なら何もしない)。例: (PARAMS, PHASH, THUMBNAIL)
+WORKERS = max(os.cpu_count() or 1, 1)
+MAX_PENDING = WORKERS * 2
+MAX_BACKLOG = MAX_PENDING * 8
+THUMB_SUFFIX = "_thumb.webp"
+WEBP_QUALITY = 90
+JPEG_QUALITY = 92
+PARAMS_KEY = "parameters"
+
+# --- 子プロセスで実行する処理 ---
+def sidecar_path(path, suffix):
+    return os.path.splitext(path)[0] + suffix
+
+def write_atomic(image, path, **save_args):
+    tmp_path = path + ".tmp"
+    image.save(tmp_path, **save_args)
+    os.replace(tmp_path, path)
+
+def embed_params(path, params):
+    # ComfyUI が書いた prompt / workflow の tEXt は残したまま parameters を追加する
+    with Image.open(path) as image:
+        if image.format != "PNG":
+            return None
+        image.load()
+        info = PngInfo()
+        for key, value in image.text.items():
+            if key != PARAMS_KEY:
+                info.add_text(key, value)
+        info.add_text(PARAMS_KEY, json.dumps(params, ensure_ascii=False))
+        write_atomic(image, path, format="PNG", pnginfo=info)
+    return PARAMS_KEY
+
+def perceptual_hash(path):
+    # dHash (64 bit): 9x8 のグレースケールで隣接画素の大小を並べる
+    with Image.open(path) as image:
+        small = image.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def make_thumbnail(path, size=th.THUMB_SIZE):
+    dest = sidecar_path(path, THUMB_SUFFIX)
+    with Image.open(path) as image:
+        write_atomic(th.render_thumbnail(image, size), dest, **th.save_args())
+    return dest
+
+def transcode(path, step):
+    dest = sidecar_path(path, ".webp" if step == WEBP else ".jpg")
+    with Image.open(path) as image:
+        if step == WEBP:
+            write_atomic(image, dest, format="WEBP", quality=WEBP_QUALITY)
+        else:
+            write_atomic(image.convert("RGB"), dest, format="JPEG", quality=JPEG_QUALITY)
+    return dest
+
+def process_image(path, steps, params):
+    # {step: 結果} / 失敗した step は {"error": メッセージ}
+    results = {}
+    for step in (s for s in ALL_STEPS if s in steps):
+        try:
+            if step == PARAMS:
+                results[step] = embed_params(path, params) if params else None
+            elif step == PHASH:
+                results[step] = perceptual_hash(path)
+            elif step == THUMBNAIL:
+                results[step] = make_thumbnail(path)
+            else:
+                results[step] = transcode(path, step)
+        except Exception as e:
+            results[step] = {"error": str(e)}
+    return results
+
+# --- 親プロセス側 ---
+pool_lock = threading.Lock()
+pool = {"executor": None, "slots": None, "feeder": None}
+backlog = queue.Queue()     # 投入待ち: (path, params, on_done)。件数は submit が MAX_BACKLOG で抑える
+room = threading.Condition()    # 投入待ちが減ったら通知
+
+def configure(steps=None, workers=None, max_pending=None, max_backlog=None):
+    global STEPS, WORKERS, MAX_PENDING, MAX_BACKLOG
+    if steps is not None:
+        unknown = set(steps) - set(ALL_STEPS)
+        if unknown:
+            raise ValueError(f"unknown post-process steps: {sorted(unknown)}")
+        STEPS = tuple(steps)
+    if workers is not None or max_pending is not None:
+        shutdown()
+        WORKERS = workers or WORKERS
+        MAX_PENDING = max_pending or WORKERS * 2
+    if max_backlog is not None:
+        MAX_BACKLOG = max_backlog
+
+def get_pool():
+    with pool_lock:
+        if pool["executor"] is None:
+            pool["executor"] = ProcessPoolExecutor(max_workers=WORKERS,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+            pool["slots"] = threading.BoundedSemaphore(MAX_PENDING)
+        return pool["executor"], pool["slots"]
+
+def is_enabled():
+    return bool(STEPS)
+
+def backlog_depth():
+    return backlog.qsize()
+
+def is_backlogged():
+    return backlog_depth() >= max(MAX_BACKLOG // 2, 1)
+
+def wait_for_room(timeout=None):
+    # is_backlogged() が解消するまで待つ (timeout 時は False)
+    with room:
+        return room.wait_for(lambda: not is_backlogged(), timeout)
+
+def submit(path, params, on_done):
+    # ブロックしない。on_done(path, results, error) はプール管理スレッド (投入失敗時は投入スレッド、
+    # 投入待ちが MAX_BACKLOG 件で溢れた時は呼び出し元) から呼ばれる
+    if backlog_depth() >= MAX_BACKLOG:
+        on_done(path, None, RuntimeError(f"post-process backlog full ({MAX_BACKLOG} waiting)"))
+        return
+    ensure_feeder()
+    backlog.put((path, params, on_done))
+
+def ensure_feeder():
+    with pool_lock:
+        if pool["feeder"] is None or not pool["feeder"].is_alive():
+            feeder = threading.Thread(target=feed, name="postprocess-feeder")
+            feeder.daemon = True
+            feeder.start()
+            pool["feeder"] = feeder
+
+def feed():
+    while True:
+        path, params, on_done = backlog.get()
+        with room:
+            room.notify_all()
+        executor, slots = get_pool()
+        slots.acquire()         # 投入中が MAX_PENDING 件ならここで待つ
+        try:
+            future = executor.submit(process_image, path, STEPS, params)
+        except Exception as e:  # shutdown 済みのプールなど
+            slots.release()
+            on_done(path, None, e)
+            continue
+        future.add_done_callback(partial(finish, path, slots, on_done))
+
+def finish(path, slots, on_done, future):
+    slots.release()
+    error = future.exception()
+    on_done(path, None if error else future.result(), error)
+
+def shutdown(wait=True):
+    with pool_lock:
+        executor = pool["executor"]
+        pool["executor"] = pool["slots"] = None
+    if executor is not None:
+        executor.shutdown(wait=wait)
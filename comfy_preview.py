@@ -0,0 +1,89 @@
+import io
+import json
+import time
+import struct
+import threading
+from collections import namedtuple, OrderedDict
+from PIL import Image
+
+# サンプリング中に ComfyUI が送るバイナリのプレビューフレーム (--preview-method 指定時)。
+# フレーム先頭 4 バイト (big endian) がイベント種別:
+#   1 PREVIEW_IMAGE                : + 画像形式 4 バイト (1=JPEG, 2=PNG) + 画像
+#   4 PREVIEW_IMAGE_WITH_METADATA  : + JSON 長 4 バイト + JSON (prompt_id, image_type など) + 画像
+# 画像は memoryview のまま保持し (コピーしない)、prompt ごとに最新 1 枚だけ残す。
+# デコードは UI が取りに来た時に、最大 PREVIEW_FPS 回/秒だけ行う。
+
+PREVIEW_IMAGE = 1
+UNENCODED_PREVIEW_IMAGE = 2
+TEXT = 3
+PREVIEW_IMAGE_WITH_METADATA = 4
+
+IMAGE_TYPES = {1: "image/jpeg", 2: "image/png"}
+
+PREVIEW_FPS = 4.0
+MAX_PREVIEW_PROMPTS = 8
+
+Frame = namedtuple("Frame", ["event", "prompt_id", "mime", "image"])
+
+preview_lock = threading.Lock()
+slots = OrderedDict()       # prompt_id -> {"image", "mime", "seq", "ts"} (古い順に破棄)
+delivered = {"ts": 0.0, "key": None, "image": None}
+
+def parse_frame(data):
+    # 対応しないイベント・壊れたフレームは None
+    view = memoryview(data)
+    if len(view) < 8:
+        return None
+    event, value = struct.unpack_from(">II", view, 0)
+    if event == PREVIEW_IMAGE:
+        mime = IMAGE_TYPES.get(value)
+        return Frame(event, None, mime, view[8:]) if mime else None
+    if event == PREVIEW_IMAGE_WITH_METADATA:
+        end = 8 + value
+        if end > len(view):
+            return None
+        metadata = json.loads(bytes(view[8:end]))
+        return Frame(event, metadata.get("prompt_id"), metadata.get("image_type", "image/jpeg"), view[end:])
+    return None
+
+def publish(prompt_id, image, mime):
+    with preview_lock:
+        slot = slots.get(prompt_id)
+        seq = slot["seq"] + 1 if slot else 1
+        slots[prompt_id] = {"image": image, "mime": mime, "seq": seq, "ts": time.time()}
+        slots.move_to_end(prompt_id)
+        while len(slots) > MAX_PREVIEW_PROMPTS:
+            slots.popitem(last=False)
+
+def discard(prompt_id):
+    with preview_lock:
+        slots.pop(prompt_id, None)
+
+def clear():
+    with preview_lock:
+        slots.clear()
+        delivered.update(ts=0.0, key=None, image=None)
+
+def get_latest_frame():
+    # (prompt_id, seq, 画像バイト列の memoryview, mime) / 無ければ None
+    with preview_lock:
+        if not slots:
+            return None
+        prompt_id = next(reversed(slots))
+        slot = slots[prompt_id]
+        return prompt_id, slot["seq"], slot["image"], slot["mime"]
+
+def get_preview_if_changed(last_key):
+    # UI タイマー用: 新しいフレームが無いか間隔が短すぎれば (None, last_key)
+    frame = get_latest_frame()
+    if frame is None:
+        return None, last_key
+    prompt_id, seq, image, mime = frame
+    key = (prompt_id, seq)
+    now = time.time()
+    if key == last_key or now - delivered["ts"] < 1.0 / PREVIEW_FPS:
+        return None, last_key
+    decoded = Image.open(io.BytesIO(image))
+    decoded.load()
+    delivered.update(ts=now, key=key, image=decoded)
+    return decoded, key
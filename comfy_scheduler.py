@@ -0,0 +1,87 @@
+from collections import deque
+
+# queue_prompt の手前で待機中ジョブを並べ替え、同じ checkpoint のジョブをまとめて投げる。
+# ComfyUI は checkpoint が切り替わるたびに数 GB の重みを読み直すので、混在したキューでは
+# 並べ替えるだけで大きく速くなる。CLIP skip / 解像度は同じ checkpoint 内での並び順にだけ使う。
+# - 並べ替えは先読みした最大 window 件の中だけで行う (巨大・無限の jobs でもメモリ一定)
+# - 1 件のジョブが後回しにされる回数は max_bypass 回まで (飢餓防止)
+
+REORDER_WINDOW = 32
+MAX_BYPASS = 64             # 解像度 × checkpoint のグリッドを window 内でまとめ切れるだけの余裕
+AFFINITY_FIELDS = ("model_name",)                               # 切り替えを減らしたい項目
+SECONDARY_FIELDS = ("stop_at_clip_layer", "width", "height")    # 同じ checkpoint 内でのまとめ方
+
+def affinity_key(job):
+    # (checkpoint, 副キー)。切り替え回数は checkpoint だけで数える
+    return (tuple(job.get(field) for field in AFFINITY_FIELDS),
+            tuple(job.get(field) for field in SECONDARY_FIELDS))
+
+class AffinityScheduler:
+    def __init__(self, jobs, window=REORDER_WINDOW, max_bypass=MAX_BYPASS, key=affinity_key):
+        self.jobs = iter(jobs)
+        self.window = max(int(window), 1)
+        self.max_bypass = max_bypass
+        self.key = key
+        self.pending = deque()      # [job, key, 後回しにされた回数] (到着順)
+        self.exhausted = False
+        self.last_key = None
+        self.swaps = 0              # checkpoint の切り替え回数 (統計用)
+
+    def fill(self):
+        while not self.exhausted and len(self.pending) < self.window:
+            job = next(self.jobs, None)
+            if job is None:
+                self.exhausted = True
+                break
+            self.pending.append([job, self.key(job), 0])
+
+    def pick_index(self):
+        # 1. 上限まで後回しにされたジョブがあれば最優先 (先頭側ほど古い)
+        # 2. 直前と同じ checkpoint・同じ副キーの最古のジョブ
+        # 3. 直前と同じ checkpoint の最古のジョブ
+        # 4. 無ければ最古のジョブ (新しい checkpoint を開始)
+        same_checkpoint = None
+        for i, (job, key, bypassed) in enumerate(self.pending):
+            if bypassed >= self.max_bypass:
+                return i
+        if self.last_key is None:
+            return 0
+        for i, (job, key, bypassed) in enumerate(self.pending):
+            if key == self.last_key:
+                return i
+            if same_checkpoint is None and key[0] == self.last_key[0]:
+                same_checkpoint = i
+        return 0 if same_checkpoint is None else same_checkpoint
+
+    def next_job(self):
+        self.fill()
+        if not self.pending:
+            return None
+        index = self.pick_index()
+        for i in range(index):
+            self.pending[i][2] += 1
+        job, key, bypassed = self.pending[index]
+        del self.pending[index]
+        if self.last_key is not None and key[0] != self.last_key[0]:
+            self.swaps += 1
+        self.last_key = key
+        return job
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        job = self.next_job()
+        if job is None:
+            raise StopIteration
+        return job
+
+def count_swaps(jobs, key=affinity_key):
+    # 並べ替え無しで投げた場合の checkpoint の切り替え回数 (比較用)
+    swaps, last = 0, None
+    for job in jobs:
+        current = key(job)[0]
+        if last is not None and current != last:
+            swaps += 1
+        last = current
+    return swaps
@@ -1,92 +1,232 @@
-import os
-import time
 import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import comfy_api as capi
+import comfy_images as ci
+import comfy_metrics as cm
+import comfy_postprocess as cpp
+import comfy_journal as cj
+import file_watch as fw
+import result_cache as rc
+import task_store as ts
+from task_store import QUEUED, RUNNING, GENERATED, SAVED, FAILED, STATE
 
-GENERATED = "generated"
-SAVED = "saved"
 PATHS = "paths"
+URL = "url"             # prompt を投げたバックエンド
+IMAGES = "images"       # /view 用の出力参照 [{"filename", "subfolder", "type"}]
+PRIORITY = "priority"
+PARAMS = "params"               # 生成パラメータ (後処理で PNG に埋め込む)
+POSTPROCESS = "postprocess"     # 後処理結果 {path: {step: 結果}}
+POSTPROCESS_PENDING = "postprocess_pending"
+CANCELLED = "cancelled"
 
-task_status_lock = threading.Lock()
-task_status = {}
+# 優先度クラス: 対話 (UI からの生成) はサーバーのキューの先頭に積み、新しい入力で古いものを置き換える
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+FILE_WAIT_TIMEOUT = 10.0
+FINISH_WORKERS = 4
+
+# 完了後の後始末 (/history 取得・ファイル待ち) は prompt ごとにスレッドを立てず共有プールで行う
+finish_pool = ThreadPoolExecutor(max_workers=FINISH_WORKERS, thread_name_prefix="comfy-finish")
+
+tasks = ts.TaskStore()
+task_status = tasks.tasks       # 参照用 (更新は tasks 経由で行う)
 
 def clear_task_status():
-    with task_status_lock:
-        task_status.clear()
+    tasks.clear()
+
+def init_task_status(prompt_id, url, priority=BATCH, params=None):
+    hit = rc.take_hit(prompt_id)
+    if hit is not None:
+        # 結果キャッシュのヒット: サーバーを介さず保存済みの出力で完了させる
+        tasks.add(prompt_id, **{PATHS:hit[PATHS], IMAGES:hit[IMAGES], URL:hit[URL] or url,
+                                PRIORITY:priority, PARAMS:params, "cached":True})
+        tasks.set_state(prompt_id, GENERATED)
+        finish_pool.submit(image_saved, prompt_id)
+        return
+    tasks.add(prompt_id, **{PATHS:[], IMAGES:[], URL:url, PRIORITY:priority, PARAMS:params})
+    cj.record_submitted(prompt_id, url, params, priority, capi.get_client_id())
+    capi.watch_prompt(prompt_id, url)       # 共有 WebSocket に購読登録
+    return
+
+def recover_tasks():
+    # 前のプロセスで投げたまま終わっていない prompt の追跡を再開する (再投入はしない)
+    cj.compact()
+    by_url = {}
+    for job in cj.open_jobs(capi.get_client_id()):    # 引き継いだ client_id で投げた分だけ
+        prompt_id, url = job["prompt_id"], job["url"]
+        if url is None or tasks.get(prompt_id) is not None:
+            continue
+        tasks.add(prompt_id, **{PATHS:[], IMAGES:[], URL:url, PRIORITY:job["priority"] or BATCH,
+                                PARAMS:job["params"], "recovered":True})
+        capi.watch_prompt(prompt_id, url)
+        by_url.setdefault(url, []).append(prompt_id)
+    for url, prompt_ids in by_url.items():
+        capi.reconcile_prompts(url, prompt_ids)
+    recovered = [prompt_id for prompt_ids in by_url.values() for prompt_id in prompt_ids]
+    if recovered:
+        print(f"♻️ reattached {len(recovered)} prompt(s) from the journal")
+    return recovered
 
-def init_task_status(prompt_id, url):
-    with task_status_lock:
-        task_status[prompt_id] = {GENERATED:False, SAVED:False, PATHS:[]}
+def start_generation(prompt_id):
+    tasks.set_state(prompt_id, RUNNING)
 
-    websocket_thread = threading.Thread(target=capi.websocket_receiver, args=(prompt_id, url,))
-    websocket_thread.daemon = True
-    websocket_thread.start()
+def finish_generation(prompt_id, url, outputs=None):
+    if not tasks.set_state(prompt_id, GENERATED):
+        return
+    # 出力が WebSocket ("executed") で判明していれば /history は引かない
+    refs = capi.output_images(outputs or {})
+    if refs:
+        finish_pool.submit(finish_with_outputs, prompt_id, url, refs)
+    else:
+        finish_pool.submit(finish_from_history, prompt_id, url)
     return
 
-def finish_generation(prompt_id, url):
-    with task_status_lock:
-        task_status[prompt_id][GENERATED] = True
-    paths_thread = threading.Thread(target=capi.get_image_paths, args=(prompt_id, url,))
-    paths_thread.daemon = True
-    paths_thread.start()
+def finish_from_history(prompt_id, url):
+    refs = capi.get_output_images(prompt_id, url)
+    if refs:
+        finish_with_outputs(prompt_id, url, refs)
+    else:
+        fail_generation(prompt_id, "no image outputs")
+
+def finish_with_outputs(prompt_id, url, refs):
+    tasks.update(prompt_id, **{IMAGES: refs})
+    try:
+        image_paths = capi.resolve_output_paths(prompt_id, url, refs)
+    except Exception as e:
+        fail_generation(prompt_id, f"failed to fetch outputs: {e}")
+        return
+    save_image_paths(prompt_id, image_paths)
+    image_saved(prompt_id)
+
+def fail_generation(prompt_id, message, **fields):
+    rc.forget(prompt_id)
+    if not tasks.set_state(prompt_id, FAILED, error=message, **fields):
+        return
+    if not rc.is_cached(prompt_id):
+        cj.record_finished(prompt_id, cj.FAILED, error=message)
+    cm.mark(prompt_id, cm.FAILED)
+    print(f"⚠️ generation failed: {prompt_id} ({message})")
+    sem_view.release()
     return
 
+def cancel_generation(prompt_id):
+    # 購読解除とサーバー側の取り消しは capi.cancel_prompts が行う
+    fail_generation(prompt_id, CANCELLED, **{CANCELLED: True})
+
 def generation_is_finished(prompt_id):
-    with task_status_lock:
-        if task_status[prompt_id][GENERATED]:
-            return True
-    return False
-
-def is_file_finished(path, wait_time=0.5, max_attempts=10):
-    for _ in range(max_attempts):
-        if not os.path.exists(path):
-            time.sleep(wait_time)
-            continue
-        size1 = os.path.getsize(path)
-        time.sleep(wait_time)
-        size2 = os.path.getsize(path)
-        if size1 == size2:
-            return True
-    return False
+    return bool(tasks.field(prompt_id, GENERATED, False))
 
+def is_file_finished(path, timeout=FILE_WAIT_TIMEOUT):
+    return fw.wait_for_file(path, timeout)
+
+# 表示用 Semaphore: prompt が終わるたび (保存・失敗・取り消しのどれでも) 1 回 release する。
+# 待ち手は起きた後 get_latest_path() / get_latest_image() が None (失敗・取り消しで画像が無い) を返しうる前提で扱う
 sem_view = threading.Semaphore(0)
 
 def image_saved(prompt_id):
-    with task_status_lock:
-        paths = task_status[prompt_id][PATHS]
+    paths = tasks.field(prompt_id, PATHS, [])
 
     for path in paths:
-        attempts = 0
-        while not is_file_finished(path) and attempts < 20:
-            time.sleep(0.2)
-            attempts += 1
         if is_file_finished(path):
-            print(f"image saved: {path}")
+            capi.info(f"image saved: {path}")
         else:
             print(f"⚠️ timeout waiting for file: {path}")
 
-    with task_status_lock:
-        task_status[prompt_id][SAVED] = True
-    sem_view.release()      #表示用Semaphoreリリース
+    if not tasks.set_state(prompt_id, SAVED):
+        return
+    cm.mark(prompt_id, cm.FILE_READY)
+    sem_view.release()      #表示用Semaphoreリリース (キャッシュ・ジャーナルの記録より先に)
+    rc.on_saved(prompt_id, paths, tasks.field(prompt_id, IMAGES, []), tasks.field(prompt_id, URL))
+    if not rc.is_cached(prompt_id):
+        cj.record_finished(prompt_id, cj.SAVED, paths=paths)
+    if cpp.is_enabled() and not tasks.field(prompt_id, "cached"):
+        start_postprocess(prompt_id, paths)
     return
 
+# --- 後処理 (comfy_postprocess のプロセスプール) ---
+# 結果は画像ごとに届いた順で task の POSTPROCESS に反映する
+postprocess_lock = threading.Lock()
+
+def start_postprocess(prompt_id, paths):
+    tasks.update(prompt_id, **{POSTPROCESS: {}, POSTPROCESS_PENDING: len(paths)})
+    params = tasks.field(prompt_id, PARAMS)
+    for path in paths:
+        cpp.submit(path, params, partial(postprocess_done, prompt_id))
+
+def postprocess_done(prompt_id, path, results, error):
+    if error is not None:
+        print(f"⚠️ post-process failed: {path} ({error})")
+        results = {"error": str(error)}
+    with postprocess_lock:
+        merged = dict(tasks.field(prompt_id, POSTPROCESS) or {})
+        merged[path] = results
+        pending = max((tasks.field(prompt_id, POSTPROCESS_PENDING) or 1) - 1, 0)
+        tasks.update(prompt_id, **{POSTPROCESS: merged, POSTPROCESS_PENDING: pending})
+
+def postprocess_backlogged(timeout=0):
+    # 後処理の投入待ちが溜まっていれば timeout 秒まで解消を待ち、それでも溜まっていれば True
+    if not cpp.is_enabled() or not cpp.is_backlogged():
+        return False
+    return not cpp.wait_for_room(timeout)
+
+def get_postprocess(prompt_id):
+    # (結果, 未完了の枚数)
+    return tasks.field(prompt_id, POSTPROCESS) or {}, tasks.field(prompt_id, POSTPROCESS_PENDING, 0)
+
+def is_done(prompt_id):
+    return tasks.is_done(prompt_id)
+
+def wait_any_done(prompt_ids, timeout=None):
+    # prompt_ids のうち SAVED / FAILED になったものを返す (timeout 時は空)
+    return tasks.wait_any_done(prompt_ids, timeout)
+
+def is_running(prompt_id):
+    return tasks.field(prompt_id, STATE) == RUNNING
+
+def get_active_ids(priority=None):
+    # サーバー側で待機中・実行中の prompt (priority を指定するとそのクラスだけ)
+    ids = tasks.ids_in(QUEUED) | tasks.ids_in(RUNNING)
+    if priority is None:
+        return ids
+    return {prompt_id for prompt_id in ids if tasks.field(prompt_id, PRIORITY) == priority}
+
+def get_task(prompt_id):
+    return tasks.get(prompt_id)
+
+def get_task_url(prompt_id):
+    return tasks.field(prompt_id, URL)
+
+def get_state_ids(state):
+    return tasks.ids_in(state)
+
 def is_last_saved():
-    with task_status_lock:
-        if task_status:
-            last_prompt_id = list(task_status.keys())[-1]
-            if task_status[last_prompt_id][SAVED] == False:
-                return False
-            else:
-                return True
-        else:
-            return True
+    prompt_id, status = tasks.latest()
+    if status is None:
+        return True
+    return status[SAVED] or status[FAILED]
 
 def get_latest_path():
-    with task_status_lock:
-        prompt_id = list(task_status.keys())[-1]
-        path = task_status[prompt_id][PATHS][0]
-    return path
+    # 最新 prompt の先頭画像のパス (未登録・失敗・取り消しで画像が無ければ None)
+    prompt_id, status = tasks.latest()
+    if status is None or not status[PATHS]:
+        return None
+    return status[PATHS][0]
+
+def get_latest_image(thumbnail=False):
+    # 最新 prompt の先頭画像を LRU キャッシュ経由で返す (無ければ None)
+    prompt_id, status = tasks.latest()
+    if status is None or not status[IMAGES]:
+        return None
+    url, ref, path = status[URL], status[IMAGES][0], (status[PATHS] or [None])[0]
+    image = ci.get_thumbnail(url, prompt_id, ref, path) if thumbnail else ci.get_image(url, prompt_id, ref, path)
+    mark_displayed(prompt_id)
+    return image
+
+def mark_displayed(prompt_id):
+    # ノートブック側で独自に表示した場合もこれを呼ぶとタイムラインに記録される
+    cm.mark(prompt_id, cm.DISPLAYED)
 
 def save_image_paths(prompt_id, image_paths):
-    with task_status_lock:
-        task_status[prompt_id][PATHS] = image_paths
+    tasks.update(prompt_id, **{PATHS: image_paths})
@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import threading
+import comfy_client as cc
+
+# LoadImage 用の入力画像を /upload/image で送る。
+# ファイル名を内容ハッシュにし、ハッシュ → サーバー側の画像名 をバックエンドごとに JSON へ保存するので、
+# 同じ画像を何百ジョブで使っても各バックエンドへのアップロードは 1 回だけ (再起動後も有効)。
+# 保存済みの名前はプロセスごとに最初の 1 回だけ /view で存在確認する (入力ディレクトリが消えた場合に備える)。
+
+UPLOAD_INDEX_PATH = "/content/comfy_upload_index.json"
+UPLOAD_SUBFOLDER = "comfy_api"
+HASH_CHUNK = 1024 * 1024
+
+index_lock = threading.Lock()
+index = {"path": None, "entries": {}}  # entries: base url -> {sha256: サーバー側の画像名}
+hash_memo = {}          # 絶対パス -> (size, mtime_ns, sha256)
+upload_locks = {}       # (base url, sha256) -> Lock (同じ画像の同時アップロードを 1 回にまとめる)
+verified = set()        # このプロセスで存在を確認済みの (base url, sha256)
+
+def file_sha256(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    memo = hash_memo.get(path)
+    if memo is not None and memo[:2] == (st.st_size, st.st_mtime_ns):
+        return memo[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    hash_memo[path] = (st.st_size, st.st_mtime_ns, digest.hexdigest())
+    return hash_memo[path][2]
+
+def load_index_locked():
+    if index["path"] == UPLOAD_INDEX_PATH:
+        return
+    try:
+        with open(UPLOAD_INDEX_PATH, "r", encoding="utf-8") as f:
+            index["entries"] = json.load(f)
+    except (OSError, ValueError):
+        index["entries"] = {}
+    index["path"] = UPLOAD_INDEX_PATH
+
+def save_index_locked():
+    tmp_path = UPLOAD_INDEX_PATH + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(UPLOAD_INDEX_PATH) or ".", exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index["entries"], f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, UPLOAD_INDEX_PATH)
+    except OSError as e:
+        print(f"⚠️ failed to save upload index '{UPLOAD_INDEX_PATH}': {e}")
+
+def split_name(name):
+    subfolder, _, filename = name.rpartition("/")
+    return filename, subfolder
+
+def ensure_uploaded(base_url, path):
+    # LoadImage の image 入力にそのまま渡せる名前 ("subfolder/filename") を返す
+    url = base_url.rstrip("/")
+    sha = file_sha256(path)
+    key = (url, sha)
+    with index_lock:
+        load_index_locked()
+        lock = upload_locks.setdefault(key, threading.Lock())
+    with lock:
+        with index_lock:
+            name = index["entries"].get(url, {}).get(sha)
+            if name is not None and key in verified:
+                return name
+        client = cc.get_client(url)
+        if name is not None and cc.run_sync(client.view_exists(*split_name(name), type="input")):
+            with index_lock:
+                verified.add(key)
+            return name
+
+        ext = os.path.splitext(path)[1].lower() or ".png"
+        result = cc.run_sync(client.upload_image(path, filename=f"{sha[:32]}{ext}", subfolder=UPLOAD_SUBFOLDER))
+        name = f"{result['subfolder']}/{result['name']}" if result.get("subfolder") else result["name"]
+        with index_lock:
+            index["entries"].setdefault(url, {})[sha] = name
+            verified.add(key)
+            save_index_locked()
+        print(f"⬆️ uploaded {path} -> {url} ({name})")
+        return name
+
+def forget_backend(base_url):
+    # バックエンドの入力ディレクトリを作り直した時などに
+    url = base_url.rstrip("/")
+    with index_lock:
+        load_index_locked()
+        index["entries"].pop(url, None)
+        for key in [k for k in verified if k[0] == url]:
+            verified.discard(key)
+        save_index_locked()
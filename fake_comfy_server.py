@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import struct
+import random
+import asyncio
+import argparse
+from collections import deque
+from aiohttp import web
+
+# GPU 無しでクライアント側のオーバーヘッドを測るための ComfyUI 代替サーバー。
+# /prompt, /history, /queue, /interrupt, /view, /upload/image, /ws を実装し、
+# status / execution_start / executing / progress / progress_state / executed /
+# execution_success (--preview でバイナリのプレビューフレームも) を ComfyUI と同じ形式で送る。
+# 出力はダミー PNG を output_dir に書く。
+#
+#   python fake_comfy_server.py --port 8188 --latency 0.5 --jitter 0.1 --drop-rate 0.05
+
+def make_png(width=8, height=8, rgb=(128, 128, 128)):
+    # Pillow 無しで作る最小の RGB PNG
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    row = b"\x00" + bytes(rgb) * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b""))
+
+class FakeComfyServer:
+    def __init__(self, output_dir, latency=0.5, jitter=0.0, steps=20, workers=1, drop_rate=0.0, seed=None,
+                 preview=False):
+        self.output_dir = output_dir
+        self.latency = latency          # 1 prompt のサンプリング時間 (秒)
+        self.jitter = jitter            # latency に加える一様乱数の幅 (秒)
+        self.steps = steps
+        self.workers = workers          # 同時実行数 (複数 GPU の模擬)
+        self.drop_rate = drop_rate      # prompt ごとに WebSocket を切断する確率
+        self.preview = preview          # サンプリング中にバイナリのプレビューフレームを送る
+        self.random = random.Random(seed)
+        self.png = make_png()
+        self.number = 0
+        self.pending = deque()          # (number, prompt_id, prompt, extra_data)
+        self.running = {}               # prompt_id -> (number, prompt_id, prompt, extra_data)
+        self.interrupted = set()
+        self.history = {}
+        self.sockets = {}               # client_id -> set of WebSocketResponse
+        self.wakeup = None
+        self.file_counter = 0
+        self.input_dir = os.path.join(output_dir, "input")
+        self.uploads = 0                # /upload/image の受信回数
+        os.makedirs(self.input_dir, exist_ok=True)
+
+    # --- WebSocket ---
+    async def send(self, client_id, msg_type, data):
+        text = json.dumps({"type": msg_type, "data": data})
+        targets = self.sockets.get(client_id, set()) if client_id else set().union(*self.sockets.values())
+        for ws in list(targets):
+            try:
+                await ws.send_str(text)
+            except Exception:
+                pass
+
+    async def send_preview(self, client_id):
+        # PREVIEW_IMAGE (1) + PNG (2) + 画像
+        frame = struct.pack(">II", 1, 2) + self.png
+        for ws in list(self.sockets.get(client_id, set())):
+            try:
+                await ws.send_bytes(frame)
+            except Exception:
+                pass
+
+    async def broadcast_status(self):
+        remaining = len(self.pending) + len(self.running)
+        await self.send(None, "status", {"status": {"exec_info": {"queue_remaining": remaining}}})
+
+    async def handle_ws(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or uuid.uuid4().hex
+        self.sockets.setdefault(client_id, set()).add(ws)
+        remaining = len(self.pending) + len(self.running)
+        await ws.send_str(json.dumps({"type": "status", "data": {
+            "status": {"exec_info": {"queue_remaining": remaining}}, "sid": client_id}}))
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self.sockets.get(client_id, set()).discard(ws)
+        return ws
+
+    async def drop_client(self, client_id):
+        for ws in list(self.sockets.get(client_id, set())):
+            await ws.close()
+
+    # --- HTTP ---
+    async def handle_prompt(self, request):
+        body = await request.json()
+        prompt = body.get("prompt")
+        if not isinstance(prompt, dict):
+            return web.json_response({"error": {"type": "invalid_prompt", "message": "no prompt"}}, status=400)
+        prompt_id = body.get("prompt_id") or uuid.uuid4().hex
+        self.number += 1
+        number = -self.number if body.get("front") else self.number
+        item = (number, prompt_id, prompt, {"client_id": body.get("client_id")})
+        if body.get("front"):
+            self.pending.appendleft(item)
+        else:
+            self.pending.append(item)
+        self.wakeup.set()
+        await self.broadcast_status()
+        return web.json_response({"prompt_id": prompt_id, "number": number, "node_errors": {}})
+
+    async def handle_history(self, request):
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id:
+            entry = self.history.get(prompt_id)
+            return web.json_response({prompt_id: entry} if entry else {})
+        max_items = int(request.query.get("max_items", 0)) or None
+        items = list(self.history.items())
+        if max_items:
+            items = items[-max_items:]
+        return web.json_response(dict(items))
+
+    async def handle_get_queue(self, request):
+        def row(item):
+            number, prompt_id, prompt, extra = item
+            return [number, prompt_id, prompt, extra, []]
+        return web.json_response({"queue_running": [row(i) for i in self.running.values()],
+                                  "queue_pending": [row(i) for i in self.pending]})
+
+    async def handle_post_queue(self, request):
+        body = await request.json()
+        if body.get("clear"):
+            self.pending.clear()
+        for prompt_id in body.get("delete", []):
+            for item in list(self.pending):
+                if item[1] == prompt_id:
+                    self.pending.remove(item)
+        await self.broadcast_status()
+        return web.Response(status=200)
+
+    async def handle_interrupt(self, request):
+        try:
+            body = await request.json()
+        except Exception:
+            body = {}
+        prompt_id = body.get("prompt_id")
+        self.interrupted.update([prompt_id] if prompt_id else self.running.keys())
+        return web.Response(status=200)
+
+    async def handle_view(self, request):
+        subfolder = request.query.get("subfolder", "")
+        base_dir = self.input_dir if request.query.get("type") == "input" else self.output_dir
+        path = os.path.join(base_dir, subfolder, request.query["filename"])
+        if not os.path.isfile(path):
+            return web.Response(status=404)
+        return web.FileResponse(path)
+
+    async def handle_upload_image(self, request):
+        # ComfyUI と同じく、同名で内容も同じなら既存の名前を返し、違えば "name (n).ext" にする
+        reader = await request.multipart()
+        fields, data, filename = {}, None, None
+        async for part in reader:
+            if part.name == "image":
+                filename = os.path.basename(part.filename or "upload.png")
+                data = await part.read()
+            else:
+                fields[part.name] = await part.text()
+        if data is None:
+            return web.Response(status=400)
+        subfolder = fields.get("subfolder", "")
+        folder = os.path.join(self.input_dir, subfolder)
+        os.makedirs(folder, exist_ok=True)
+        stem, ext = os.path.splitext(filename)
+        name, n = filename, 1
+        while os.path.exists(os.path.join(folder, name)) and fields.get("overwrite") != "true":
+            with open(os.path.join(folder, name), "rb") as f:
+                if f.read() == data:
+                    break
+            name = f"{stem} ({n}){ext}"
+            n += 1
+        with open(os.path.join(folder, name), "wb") as f:
+            f.write(data)
+        self.uploads += 1
+        return web.json_response({"name": name, "subfolder": subfolder, "type": fields.get("type", "input")})
+
+    # --- 実行 ---
+    async def executor(self):
+        active = set()
+        while True:
+            while self.pending and len(active) < self.workers:
+                item = self.pending.popleft()
+                self.running[item[1]] = item
+                task = asyncio.ensure_future(self.execute(item))
+                active.add(task)
+                task.add_done_callback(active.discard)
+            self.wakeup.clear()
+            if self.pending and len(active) >= self.workers:
+                await asyncio.wait(active, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await self.wakeup.wait()
+
+    async def execute(self, item):
+        number, prompt_id, prompt, extra = item
+        client_id = extra.get("client_id")
+        base = {"prompt_id": prompt_id}
+        messages = []
+        try:
+            started = time.time()
+            await self.send(client_id, "execution_start", dict(base, timestamp=int(started * 1000)))
+            messages.append(["execution_start", dict(base, timestamp=int(started * 1000))])
+            await self.send(client_id, "execution_cached", dict(base, nodes=[]))
+            if self.random.random() < self.drop_rate:
+                await self.drop_client(client_id)
+
+            outputs = {}
+            sampling = max(self.latency + self.random.uniform(0, self.jitter), 0)
+            for node_id, node in prompt.items():
+                await self.send(client_id, "executing", dict(base, node=node_id, display_node=node_id))
+                if node.get("class_type", "").startswith("KSampler"):
+                    for step in range(1, self.steps + 1):
+                        if prompt_id in self.interrupted:
+                            raise asyncio.CancelledError
+                        await asyncio.sleep(sampling / self.steps)
+                        await self.send(client_id, "progress", dict(base, value=step, max=self.steps, node=node_id))
+                        if self.preview:
+                            await self.send_preview(client_id)
+                        await self.send(client_id, "progress_state", dict(base, nodes={node_id: {
+                            "value": step, "max": self.steps, "state": "running" if step < self.steps else "finished",
+                            "node_id": node_id, "prompt_id": prompt_id, "display_node_id": node_id}}))
+                elif node.get("class_type") == "SaveImage":
+                    images = [self.save_image(node)]
+                    outputs[node_id] = {"images": images}
+                    await self.send(client_id, "executed", dict(base, node=node_id, display_node=node_id,
+                                                               output={"images": images}))
+
+            finished = int(time.time() * 1000)
+            messages.append(["execution_success", dict(base, timestamp=finished)])
+            self.history[prompt_id] = {"prompt": [number, prompt_id, prompt, extra, list(outputs)],
+                                       "outputs": outputs,
+                                       "status": {"status_str": "success", "completed": True, "messages": messages}}
+            await self.send(client_id, "execution_success", dict(base, timestamp=finished))
+        except asyncio.CancelledError:
+            messages.append(["execution_interrupted", dict(base, timestamp=int(time.time() * 1000))])
+            self.history[prompt_id] = {"prompt": [number, prompt_id, prompt, extra, []], "outputs": {},
+                                       "status": {"status_str": "error", "completed": False, "messages": messages}}
+            await self.send(client_id, "execution_interrupted", dict(base, node_id=None))
+        finally:
+            self.interrupted.discard(prompt_id)
+            self.running.pop(prompt_id, None)
+            await self.send(client_id, "executing", dict(base, node=None))
+            await self.broadcast_status()
+            self.wakeup.set()
+
+    def save_image(self, node):
+        prefix = node.get("inputs", {}).get("filename_prefix", "ComfyUI")
+        self.file_counter += 1
+        filename = f"{prefix}_{self.file_counter:05d}_.png"
+        with open(os.path.join(self.output_dir, filename), "wb") as f:
+            f.write(self.png)
+        return {"filename": filename, "subfolder": "", "type": "output"}
+
+    # --- 起動 ---
+    async def on_startup(self, app):
+        self.wakeup = asyncio.Event()
+        app["executor"] = asyncio.ensure_future(self.executor())
+
+    async def on_shutdown(self, app):
+        for sockets in list(self.sockets.values()):
+            for ws in list(sockets):
+                await ws.close()
+
+    async def on_cleanup(self, app):
+        app["executor"].cancel()
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/prompt", self.handle_prompt)
+        app.router.add_get("/history", self.handle_history)
+        app.router.add_get("/history/{prompt_id}", self.handle_history)
+        app.router.add_get("/queue", self.handle_get_queue)
+        app.router.add_post("/queue", self.handle_post_queue)
+        app.router.add_post("/interrupt", self.handle_interrupt)
+        app.router.add_get("/view", self.handle_view)
+        app.router.add_post("/upload/image", self.handle_upload_image)
+        app.router.add_get("/ws", self.handle_ws)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ComfyUI server for client benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--output-dir", default="/tmp/fake_comfy_output")
+    parser.add_argument("--latency", type=float, default=0.5, help="sampling seconds per prompt")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform random seconds")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1, help="prompts executed concurrently")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="chance to drop the client's WebSocket per prompt")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--preview", action="store_true", help="send binary preview frames while sampling")
+    args = parser.parse_args()
+
+    server = FakeComfyServer(args.output_dir, args.latency, args.jitter, args.steps,
+                             args.workers, args.drop_rate, args.seed, args.preview)
+    web.run_app(server.make_app(), host=args.host, port=args.port, print=None, shutdown_timeout=1.0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# ComfyUI は SaveImage でファイルを書き終えてから "executed" を送るので、
+# 通常は存在確認だけで済む。共有ストレージ等で遅れて現れる場合は
+# inotify (Linux) で作成/クローズを待ち、使えない環境では短い間隔のポーリングに落とす。
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_EVENT_HEADER = struct.Struct("iIII")      # wd, mask, cookie, len
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+def wait_for_file(path, timeout=10.0, poll_interval=0.05):
+    if os.path.exists(path):
+        return True
+    deadline = time.monotonic() + timeout
+    if _libc is not None:
+        found = _wait_inotify(path, deadline)
+        if found is not None:
+            return found
+    return _wait_poll(path, deadline, poll_interval)
+
+def _wait_inotify(path, deadline):
+    directory, name = os.path.split(os.path.abspath(path))
+    fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    try:
+        wd = _libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            return None     # ディレクトリがまだ無い等 → ポーリングへ
+        if os.path.exists(path):
+            return True     # 監視登録前に書き終わっていた
+        target = os.fsencode(name)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return os.path.exists(path)
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            try:
+                buf = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(buf):
+                _, _, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                if buf[offset:offset + length].rstrip(b"\0") == target:
+                    return True
+                offset += length
+    finally:
+        os.close(fd)
+
+def _wait_poll(path, deadline, poll_interval):
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            return True
+        time.sleep(poll_interval)
+    return os.path.exists(path)
@@ -4,33 +4,40 @@ RESO_PATH = "/content/comfy_api_utils/resolutions.json"
 CKPT_DIR = "/content/ComfyUI/models/checkpoints"
 LOG_FILE = "/content/comfyui_debug_log.txt"
 
-import os
 import json
 import random
 from datetime import datetime
 import pytz
 import gradio as gr
-from functools import partial
 
 import comfy_api as capi
 import comfy_task_manager as ctm
 import comfy_log as clg
+import comfy_events as ev
+import model_catalog as mc
+import comfy_preview as cp
+import workflow_template as wt
 import importlib
+importlib.reload(ev)
+importlib.reload(cp)
+importlib.reload(mc)
 importlib.reload(capi)
 importlib.reload(ctm)
 importlib.reload(clg)
 
-def get_ckpt_choices(dir):
+def get_ckpt_choices(dir, template=None, wait=mc.REFRESH_WAIT):
+    # 索引 (model_catalog) から返す。template (CompiledTemplate) を渡すと対応しないアーキテクチャを除外する
     try:
-        files = [f for f in os.listdir(dir) if f.endswith(".safetensors") or f.endswith(".ckpt")]
-        return files
+        catalog = mc.get_catalog(dir)
+        catalog.refresh(wait)
+        return catalog.names(mc.workflow_arch(template.workflow if template is not None else None, catalog))
     except Exception as e:
         # UIに返す前にログに出力
         print(f"Error reading checkpoint dir '{dir}': {e}")
         return []
 
-def refresh_ckpt_list():
-    choices = get_ckpt_choices(CKPT_DIR)
+def refresh_ckpt_list(template=None):
+    choices = get_ckpt_choices(CKPT_DIR, template)
     if not choices:
         print("No checkpoints found in:", CKPT_DIR)
         return gr.update(choices=[], value=None)
@@ -39,19 +46,18 @@ def refresh_ckpt_list():
 def update_seed_enable(mode):
     return gr.update(interactive=(mode == "Fix"))
 
-def seed_initial_load(seed_mode):
+def seed_initial_load(seed_mode, template=None):
     seed_upd = gr.update(interactive=(seed_mode == "Fix"))
-    choices = get_ckpt_choices(CKPT_DIR)
+    choices = get_ckpt_choices(CKPT_DIR, template, wait=0)     # ページ読み込みは保存済みの索引を即返す
     dropdown_upd = gr.update(choices=choices, value=choices[0] if choices else None)
     return seed_upd, dropdown_upd
 
 def input_values( workflow_sta, node_ids_sta, presets_sta,
                   positive_prompt, negative_prompt, selected_ckpt, height, width, preset_name,
-                  seed_mode, seed_input, steps, cfg, denoise, stop_at_clip_layer):
+                  seed_mode, seed_input, steps, cfg, denoise, stop_at_clip_layer, input_image=None):
 
-    if not ctm.is_last_saved():
-        inputs = {"message" :"image not saved yet!" }
-        return json.dumps(inputs, indent=4)
+    # 前回の生成が終わっていなければ取り消して最新の入力を優先する
+    superseded = capi.cancel_prompts(ctm.get_active_ids(ctm.INTERACTIVE))
 
     preset = presets_sta.get(preset_name, {})
     sampler = preset.get("sampler", "unknown")
@@ -63,7 +69,8 @@ def input_values( workflow_sta, node_ids_sta, presets_sta,
                                         seed, width, height, steps, cfg,
                                         sampler, scheduler, denoise,
                                         selected_ckpt, stop_at_clip_layer,
-                                        filename_prefix=datetime.now(pytz.timezone('Asia/Tokyo')).strftime("%y%m%d"))
+                                        filename_prefix=datetime.now(pytz.timezone('Asia/Tokyo')).strftime("%y%m%d"),
+                                        priority=ctm.INTERACTIVE, input_image=input_image or None)
 
     inputs = {  "prompt id"       : prompt_id,
                 "positive prompt" : positive_prompt,
@@ -77,11 +84,34 @@ def input_values( workflow_sta, node_ids_sta, presets_sta,
                 "steps"           : steps,
                 "cfg"             : cfg,
                 "denoise"         : denoise,
-                "stop_at_clip"    : stop_at_clip_layer }
+                "stop_at_clip"    : stop_at_clip_layer,
+                "input_image"     : input_image,
+                "superseded"      : superseded }
+
+    if prompt_id is None:
+        # 投入失敗: タスクは登録しない (None を対話タスクとして残すと次回の取り消しが壊れる)
+        inputs["error"] = "failed to queue prompt"
+        return json.dumps(inputs, indent=4)
 
-    ctm.init_task_status(prompt_id, COMFYUI_URL)
+    ctm.init_task_status(prompt_id, COMFYUI_URL, priority=ctm.INTERACTIVE, params=inputs)
     return json.dumps(inputs, indent=4)
 
+def log_tick(last_version):
+    text, version = clg.get_log_text_if_changed(LOG_FILE, last_version)
+    return (gr.update() if text is None else text), version
+
+def ws_log_tick(last_version):
+    # イベントバスの version が変わった時だけ再描画する
+    text, progress_text, version = ev.get_text_if_changed(last_version)
+    if text is None:
+        return gr.update(), gr.update(), version
+    return text, progress_text, version
+
+def preview_tick(last_key):
+    # 新しいプレビューフレームがある時だけ差し替える (常に最新の 1 枚)
+    image, key = cp.get_preview_if_changed(last_key)
+    return (gr.update() if image is None else image), key
+
 def size_on_select(resolution_str):
     w, h = map(int, resolution_str.split("x"))
     return w, h, f"{w} x {h}"
@@ -94,6 +124,8 @@ def size_on_adjust(w, h):
 def build_gradio_ui(workflow, node_ids, presets):
 
     ctm.clear_task_status()             # task_status全削除
+    ctm.recover_tasks()                 # 再起動前に投げた prompt の追跡を再開 (ジャーナルから)
+    template = wt.compile_template(workflow, node_ids)     # 1 回だけコンパイルし、生成ごとの再ハッシュを避ける
 
     with open(RESO_PATH, "r") as f:
         resolutions = json.load(f)
@@ -109,7 +141,7 @@ def build_gradio_ui(workflow, node_ids, presets):
         css = f.read()
 
     with gr.Blocks(css=css) as demo:
-        workflow_sta = gr.State(value=workflow)
+        workflow_sta = gr.State(value=template)
         node_ids_sta = gr.State(value=node_ids)
         presets_sta = gr.State(value=presets)
         with gr.Row():
@@ -154,6 +186,10 @@ def build_gradio_ui(workflow, node_ids, presets):
                         with gr.Column():
                             cfg = gr.Slider(1.0, 15.0, value=7.5, step=0.1, label="CFG Scale")
 
+                with gr.Tab("Src-Img"):
+                    # LoadImage を含む img2img / inpaint ワークフロー用 (denoise と併用)
+                    input_image = gr.Image(label="Source Image", type="filepath")
+
                 with gr.Tab("Clp-Stp"):
                     with gr.Row():
                         stop_at_clip_layer = gr.Slider(-11, -1, value=-2, step=1, label="CLIP Stop", interactive=True)
@@ -162,26 +198,34 @@ def build_gradio_ui(workflow, node_ids, presets):
             with gr.Column():
                 run_button = gr.Button("Generate Image", elem_id="run_button")
                 with gr.Tabs():
+                    with gr.Tab("Preview"):
+                        preview_img = gr.Image(show_label=False, type="pil", interactive=False)
                     with gr.Tab("Inputs"):
                         inputs_txt = gr.Textbox(show_label=False, lines=20, interactive=False)
                     with gr.Tab("ComfyUI Log"):
                         log_box = gr.Textbox(show_label=False, lines=20, interactive=False)
                     with gr.Tab("WebSocket Log"):
+                        progress_box = gr.Textbox(label="Progress", lines=1, interactive=False)
                         ws_box = gr.Textbox(show_label=False, lines=20, interactive=False)
 
+        log_version_sta = gr.State(value=None)
+        ws_version_sta = gr.State(value=None)
+        preview_key_sta = gr.State(value=None)
         timer_log = gr.Timer(2)
-        timer_log.tick(fn=partial(clg.get_log_text, LOG_FILE), outputs=log_box)
+        timer_log.tick(fn=log_tick, inputs=log_version_sta, outputs=[log_box, log_version_sta])
         timer_ws_log = gr.Timer(1)
-        timer_ws_log.tick(fn=capi.get_ws_log_text, outputs=ws_box)
+        timer_ws_log.tick(fn=ws_log_tick, inputs=ws_version_sta, outputs=[ws_box, progress_box, ws_version_sta])
+        timer_preview = gr.Timer(1.0 / cp.PREVIEW_FPS)
+        timer_preview.tick(fn=preview_tick, inputs=preview_key_sta, outputs=[preview_img, preview_key_sta])
 
-        refresh_btn.click(refresh_ckpt_list, inputs=None, outputs=ckpt_dropdown)
+        refresh_btn.click(refresh_ckpt_list, inputs=workflow_sta, outputs=ckpt_dropdown)
         ckpt_dropdown.change(lambda x: x, inputs=ckpt_dropdown, outputs=selected_ckpt)
         seed_mode.change(update_seed_enable, inputs=seed_mode, outputs=seed_input)
-        demo.load(seed_initial_load, inputs=seed_mode, outputs=[seed_input, ckpt_dropdown])
+        demo.load(seed_initial_load, inputs=[seed_mode, workflow_sta], outputs=[seed_input, ckpt_dropdown])
 
         run_button.click(input_values,
                   inputs=[  workflow_sta, node_ids_sta, presets_sta,
                             positive_prompt, negative_prompt, selected_ckpt, height, width, preset_dropdown,
-                            seed_mode, seed_input, steps, cfg, denoise, stop_at_clip_layer],
+                            seed_mode, seed_input, steps, cfg, denoise, stop_at_clip_layer, input_image],
                   outputs=[inputs_txt, ])
     return demo
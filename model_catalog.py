@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import threading
+
+# checkpoint ディレクトリの索引。
+# - (size, mtime) が変わったファイルだけ読み直す (毎回 listdir + 全読みしない)
+# - safetensors は先頭の JSON ヘッダだけ読んでアーキテクチャ (SD1.5 / SDXL など) と metadata を得る
+# - 内容ハッシュ (sha256) はバックグラウンドで少しずつ計算する
+# - 結果は JSON に保存し、次回起動時はそれを即座に返してから差分スキャンする
+
+CATALOG_DIR = "/content"
+MODEL_EXTS = (".safetensors", ".ckpt")
+MAX_HEADER_BYTES = 100 * 1024 * 1024
+METADATA_MAX_VALUE = 512        # 学習タグ頻度などの巨大な metadata 値は保存しない
+HASH_CHUNK = 1024 * 1024
+HASH_IN_BACKGROUND = True
+REFRESH_WAIT = 5.0              # Refresh ボタンでスキャン完了を待つ最大秒数
+CATALOG_VERSION = 1
+
+SD15 = "sd15"
+SD2 = "sd2"
+SDXL = "sdxl"
+SDXL_REFINER = "sdxl_refiner"
+UNKNOWN = "unknown"
+
+# ワークフローが使うノードから分かる対応アーキテクチャ
+WORKFLOW_ARCH_NODES = {"CLIPTextEncodeSDXL": SDXL, "CLIPTextEncodeSDXLRefiner": SDXL_REFINER}
+CHECKPOINT_LOADERS = ("CheckpointLoaderSimple", "CheckpointLoader")
+
+def read_safetensors_header(path):
+    # 先頭 8 バイト (little endian u64) がヘッダ長、その後に JSON ヘッダが続く
+    with open(path, "rb") as f:
+        head = f.read(8)
+        if len(head) < 8:
+            raise ValueError("file too short")
+        (length,) = struct.unpack("<Q", head)
+        if length > MAX_HEADER_BYTES:
+            raise ValueError(f"header too large: {length}")
+        return json.loads(f.read(length))
+
+def detect_arch(tensor_names, metadata):
+    spec = str(metadata.get("modelspec.architecture", ""))
+    if spec.startswith("stable-diffusion-xl"):
+        return SDXL_REFINER if "refiner" in spec else SDXL
+    if spec.startswith("stable-diffusion-v1"):
+        return SD15
+    if spec.startswith("stable-diffusion-v2"):
+        return SD2
+    prefixes = {".".join(name.split(".", 3)[:3]) for name in tensor_names}
+    if "conditioner.embedders.1" in prefixes:
+        return SDXL
+    if "conditioner.embedders.0" in prefixes:
+        return SDXL_REFINER
+    if "cond_stage_model.transformer.text_model" in prefixes:
+        return SD15
+    if "cond_stage_model.model.transformer" in prefixes:
+        return SD2
+    return UNKNOWN
+
+def small_metadata(metadata):
+    return {k: v for k, v in metadata.items() if isinstance(v, str) and len(v) <= METADATA_MAX_VALUE}
+
+def workflow_arch(workflow, catalog=None):
+    # 1. SDXL 専用ノードがあればそれ
+    # 2. 無ければ (CLIPTextEncode だけの SD1.5 / SD2 / SDXL 兼用ワークフロー) テンプレートが読み込む
+    #    checkpoint の索引上のアーキテクチャ (refiner 以外を優先)
+    # どちらでも分からなければ None (絞り込まない)
+    if not workflow:
+        return None
+    for node in workflow.values():
+        arch = WORKFLOW_ARCH_NODES.get(node.get("class_type"))
+        if arch is not None:
+            return arch
+    if catalog is None:
+        return None
+    found = []
+    for node in workflow.values():
+        if node.get("class_type") in CHECKPOINT_LOADERS:
+            name = node.get("inputs", {}).get("ckpt_name")
+            entry = catalog.get(name) if isinstance(name, str) else None
+            if entry is not None and entry["arch"] != UNKNOWN:
+                found.append(entry["arch"])
+    base = [arch for arch in found if arch != SDXL_REFINER]
+    return (base or found or [None])[0]
+
+def is_compatible(entry, arch):
+    return arch is None or entry["arch"] in (arch, UNKNOWN)
+
+class ModelCatalog:
+    def __init__(self, root, cache_path=None):
+        self.root = root
+        key = hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()[:10]
+        self.cache_path = cache_path or os.path.join(CATALOG_DIR, f"comfy_model_catalog_{key}.json")
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.entries = {}           # root からの相対パス -> entry
+        self.loaded = False         # キャッシュかスキャンで一度でも内容が得られたか
+        self.scanned_at = None
+        self.scan_thread = None
+        self.hash_thread = None
+        self.load()
+
+    # --- 永続化 ---
+    def load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == CATALOG_VERSION and data.get("root") == self.root:
+            with self.lock:
+                self.entries = data.get("entries", {})
+                self.loaded = True
+
+    def save(self):
+        with self.lock:
+            data = {"version": CATALOG_VERSION, "root": self.root,
+                    "entries": {name: dict(entry) for name, entry in self.entries.items()}}
+        with self.save_lock:
+            tmp_path = self.cache_path + ".tmp"
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                print(f"⚠️ failed to save model catalog '{self.cache_path}': {e}")
+
+    # --- スキャン ---
+    def walk(self, path=None, visited=None):
+        # ディレクトリの symlink はたどるが、実パスで一度見たディレクトリには入らない (ループ対策)
+        path = path or self.root
+        visited = set() if visited is None else visited
+        real = os.path.realpath(path)
+        if real in visited:
+            return
+        visited.add(real)
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=True):
+                    yield from self.walk(entry.path, visited)
+                elif entry.name.endswith(MODEL_EXTS):
+                    yield os.path.relpath(entry.path, self.root), entry.stat()
+
+    def index_file(self, name, st):
+        entry = {"name": name, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                 "arch": UNKNOWN, "metadata": {}, "sha256": None, "error": None}
+        if name.endswith(".safetensors"):
+            try:
+                header = read_safetensors_header(os.path.join(self.root, name))
+                metadata = header.pop("__metadata__", None) or {}
+                entry["arch"] = detect_arch(header.keys(), metadata)
+                entry["metadata"] = small_metadata(metadata)
+            except (OSError, ValueError) as e:
+                entry["error"] = str(e)
+        return entry
+
+    def scan(self):
+        # 差分スキャン。変化があれば保存して True を返す
+        with self.lock:
+            old = dict(self.entries)
+        found = {}
+        changed = False
+        for name, st in self.walk():
+            entry = old.get(name)
+            if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+                entry = self.index_file(name, st)
+                changed = True
+            found[name] = entry
+        changed = changed or len(found) != len(old)
+        with self.lock:
+            self.entries = found
+            self.loaded = True
+            self.scanned_at = time.time()
+        if changed:
+            self.save()
+        if HASH_IN_BACKGROUND:
+            self.start_hashing()
+        return changed
+
+    def scan_safely(self):
+        try:
+            self.scan()
+        except OSError as e:
+            print(f"Error reading checkpoint dir '{self.root}': {e}")
+
+    def refresh(self, wait=REFRESH_WAIT):
+        # バックグラウンドで差分スキャンし、最大 wait 秒だけ完了を待つ
+        # (まだ何も分かっていない初回は完了まで待つ)
+        with self.lock:
+            thread = self.scan_thread
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self.scan_safely, name="model-catalog-scan")
+                thread.daemon = True
+                thread.start()
+                self.scan_thread = thread
+            loaded = self.loaded
+        thread.join(None if not loaded else wait)
+
+    # --- 内容ハッシュ ---
+    def start_hashing(self):
+        with self.lock:
+            if self.hash_thread is not None and self.hash_thread.is_alive():
+                return
+            self.hash_thread = threading.Thread(target=self.hash_pending, name="model-catalog-hash")
+            self.hash_thread.daemon = True
+            self.hash_thread.start()
+
+    def hash_pending(self):
+        while True:
+            with self.lock:
+                pending = [e for e in self.entries.values() if e.get("sha256") is None and not e.get("error")]
+            if not pending:
+                return
+            entry = min(pending, key=lambda e: e["name"])
+            path = os.path.join(self.root, entry["name"])
+            try:
+                digest = hash_file(path)
+                st = os.stat(path)
+            except OSError as e:
+                with self.lock:
+                    entry["error"] = str(e)
+                continue
+            with self.lock:
+                if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]:
+                    entry["sha256"] = digest
+                else:
+                    entry["error"] = "changed while hashing"     # 次のスキャンで読み直される
+            self.save()
+
+    # --- 参照 ---
+    def list(self, arch=None):
+        with self.lock:
+            entries = [dict(e) for e in self.entries.values() if is_compatible(e, arch)]
+        return sorted(entries, key=lambda e: e["name"].lower())
+
+    def names(self, arch=None):
+        return [entry["name"] for entry in self.list(arch)]
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+            return dict(entry) if entry else None
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+catalog_lock = threading.Lock()
+catalogs = {}       # root -> ModelCatalog
+
+def get_catalog(root):
+    with catalog_lock:
+        catalog = catalogs.get(root)
+        if catalog is None:
+            catalog = ModelCatalog(root)
+            catalogs[root] = catalog
+    return catalog
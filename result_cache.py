@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# パッチ済みワークフローの内容ハッシュ → 既存の出力ファイル の永続インデックス (SQLite)。
+# 同じシード・同じ設定のジョブはサーバーに投げず、既存の出力を通常のタスク状態として返す。
+# 結果に影響しない項目 (_meta, filename_prefix) はハッシュから除外する。
+
+RESULT_CACHE_PATH = "/content/comfy_result_cache.sqlite"
+RESULT_CACHE_ENABLED = True
+MAX_ENTRIES = 10000
+MAX_PENDING = 10000
+CACHED_PREFIX = "cached-"           # キャッシュヒット時に払い出す prompt_id の接頭辞
+
+NON_SEMANTIC_INPUTS = ("filename_prefix",)
+
+cache_lock = threading.Lock()
+state = {"conn": None, "path": None}
+pending_keys = OrderedDict()    # prompt_id -> key (投入済み・保存待ち)
+pending_hits = OrderedDict()    # 払い出した prompt_id -> ヒットした行
+
+def canonicalize(prompt):
+    nodes = {}
+    for node_id, node in prompt.items():
+        inputs = {k: v for k, v in node.get("inputs", {}).items() if k not in NON_SEMANTIC_INPUTS}
+        nodes[str(node_id)] = {"class_type": node.get("class_type"), "inputs": inputs}
+    return json.dumps(nodes, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def prompt_key(prompt):
+    return hashlib.sha256(canonicalize(prompt).encode("utf-8")).hexdigest()
+
+def connect_locked():
+    if state["conn"] is None or state["path"] != RESULT_CACHE_PATH:
+        if state["conn"] is not None:
+            state["conn"].close()
+        os.makedirs(os.path.dirname(RESULT_CACHE_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(RESULT_CACHE_PATH, check_same_thread=False)
+        conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                            key TEXT PRIMARY KEY, paths TEXT NOT NULL, images TEXT NOT NULL,
+                            url TEXT, created REAL NOT NULL, last_used REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        conn.commit()
+        state["conn"], state["path"] = conn, RESULT_CACHE_PATH
+    return state["conn"]
+
+def lookup(key):
+    # 出力ファイルが全て残っている場合のみヒット (欠けていれば行を消してミス)
+    # インデックスが開けない・壊れている場合もミス扱いにして生成は続ける
+    try:
+        with cache_lock:
+            conn = connect_locked()
+            row = conn.execute("SELECT paths, images, url FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            paths = json.loads(row[0])
+            if not paths or not all(os.path.exists(path) for path in paths):
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️ result cache lookup failed: {e}")
+        return None
+    return {"key": key, "paths": paths, "images": json.loads(row[1]), "url": row[2]}
+
+def store(key, paths, images, url=None):
+    if not paths:
+        return
+    now = time.time()
+    try:
+        with cache_lock:
+            conn = connect_locked()
+            conn.execute("INSERT OR REPLACE INTO results (key, paths, images, url, created, last_used) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (key, json.dumps(paths), json.dumps(images), url, now, now))
+            evict_locked(conn)
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        print(f"⚠️ result cache write failed: {e}")
+
+def evict_locked(conn, max_entries=None):
+    max_entries = MAX_ENTRIES if max_entries is None else max_entries
+    (count,) = conn.execute("SELECT COUNT(*) FROM results").fetchone()
+    if count > max_entries:
+        conn.execute("DELETE FROM results WHERE key IN "
+                     "(SELECT key FROM results ORDER BY last_used ASC LIMIT ?)", (count - max_entries,))
+
+def validate():
+    # 削除されたファイルを指す行を掃除し、削除件数を返す
+    with cache_lock:
+        conn = connect_locked()
+        rows = conn.execute("SELECT key, paths FROM results").fetchall()
+        stale = [(key,) for key, paths in rows if not all(os.path.exists(p) for p in json.loads(paths))]
+        conn.executemany("DELETE FROM results WHERE key = ?", stale)
+        conn.commit()
+    return len(stale)
+
+def clear():
+    with cache_lock:
+        conn = connect_locked()
+        conn.execute("DELETE FROM results")
+        conn.commit()
+
+# --- generate_image_with_api / タスク管理との受け渡し ---
+def remember(prompt_id, key):
+    with cache_lock:
+        pending_keys[prompt_id] = key
+        while len(pending_keys) > MAX_PENDING:
+            pending_keys.popitem(last=False)
+
+def forget(prompt_id):
+    with cache_lock:
+        pending_keys.pop(prompt_id, None)
+        pending_hits.pop(prompt_id, None)
+
+def issue_hit(hit):
+    prompt_id = CACHED_PREFIX + uuid.uuid4().hex
+    with cache_lock:
+        pending_hits[prompt_id] = hit
+        while len(pending_hits) > MAX_PENDING:
+            pending_hits.popitem(last=False)
+    return prompt_id
+
+def is_cached(prompt_id):
+    return str(prompt_id).startswith(CACHED_PREFIX)
+
+def take_hit(prompt_id):
+    with cache_lock:
+        return pending_hits.pop(prompt_id, None)
+
+def on_saved(prompt_id, paths, images, url):
+    with cache_lock:
+        key = pending_keys.pop(prompt_id, None)
+    if key is not None:
+        store(key, paths, images, url)
@@ -0,0 +1,156 @@
+import time
+import threading
+from collections import OrderedDict
+
+# prompt ごとのタスク状態ストア。
+# - "最新" と状態別集合 (queued / running / generated / saved / failed) を O(1) で参照
+# - 終了したタスクは件数上限と TTL で古い順に破棄 (最新タスクは残す)
+# - ロックは短時間の辞書操作のみで保持し、I/O は呼び出し側でロック外に行う
+
+QUEUED = "queued"
+RUNNING = "running"
+GENERATED = "generated"
+SAVED = "saved"
+FAILED = "failed"
+
+STATES = (QUEUED, RUNNING, GENERATED, SAVED, FAILED)
+FINISHED_STATES = (SAVED, FAILED)
+
+STATE = "state"
+CREATED_AT = "created_at"
+FINISHED_AT = "finished_at"
+
+MAX_FINISHED_TASKS = 1000
+FINISHED_TTL = 6 * 60 * 60      # 秒
+
+class TaskStore:
+    def __init__(self, max_finished=MAX_FINISHED_TASKS, finished_ttl=FINISHED_TTL):
+        self.max_finished = max_finished
+        self.finished_ttl = finished_ttl
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)      # 終了通知用
+        self.tasks = OrderedDict()                      # prompt_id -> record (登録順)
+        self.by_state = {state: set() for state in STATES}
+        self.finished = OrderedDict()                   # prompt_id -> finished_at (終了順)
+        self.latest_id = None
+
+    def clear(self):
+        with self.lock:
+            self.tasks.clear()
+            self.finished.clear()
+            for ids in self.by_state.values():
+                ids.clear()
+            self.latest_id = None
+
+    def add(self, prompt_id, **fields):
+        with self.lock:
+            old = self.tasks.pop(prompt_id, None)
+            if old is not None:
+                self.by_state[old[STATE]].discard(prompt_id)
+                self.finished.pop(prompt_id, None)
+            record = {STATE: QUEUED, GENERATED: False, SAVED: False, FAILED: False,
+                      CREATED_AT: time.time(), FINISHED_AT: None}
+            record.update(fields)
+            self.tasks[prompt_id] = record
+            self.by_state[QUEUED].add(prompt_id)
+            self.latest_id = prompt_id
+            self.evict_locked()
+        return record
+
+    def set_state(self, prompt_id, state, **fields):
+        with self.lock:
+            record = self.tasks.get(prompt_id)
+            if record is None:          # 破棄済み・キャンセル済みへの遅延イベント
+                return False
+            if record[STATE] in FINISHED_STATES and state not in FINISHED_STATES:
+                return False            # 終了後に running 等へ戻さない
+            self.by_state[record[STATE]].discard(prompt_id)
+            self.by_state[state].add(prompt_id)
+            record[STATE] = state
+            record[GENERATED] = record[GENERATED] or state in (GENERATED, SAVED, FAILED)
+            record[SAVED] = state == SAVED
+            record[FAILED] = state == FAILED
+            record.update(fields)
+            if state in FINISHED_STATES:
+                record[FINISHED_AT] = time.time()
+                self.finished[prompt_id] = record[FINISHED_AT]
+                self.finished.move_to_end(prompt_id)
+                self.evict_locked()
+                self.cond.notify_all()
+        return True
+
+    def update(self, prompt_id, **fields):
+        with self.lock:
+            record = self.tasks.get(prompt_id)
+            if record is None:
+                return False
+            record.update(fields)
+        return True
+
+    def remove(self, prompt_id):
+        with self.lock:
+            self.remove_locked(prompt_id)
+            self.cond.notify_all()
+
+    def remove_locked(self, prompt_id):
+        record = self.tasks.pop(prompt_id, None)
+        if record is None:
+            return
+        self.by_state[record[STATE]].discard(prompt_id)
+        self.finished.pop(prompt_id, None)
+        if self.latest_id == prompt_id:
+            self.latest_id = next(reversed(self.tasks), None)
+
+    def evict_locked(self):
+        now = time.time()
+        while self.finished:
+            prompt_id, finished_at = next(iter(self.finished.items()))
+            expired = self.finished_ttl is not None and now - finished_at > self.finished_ttl
+            if len(self.finished) <= self.max_finished and not expired:
+                break
+            if prompt_id == self.latest_id:
+                self.finished.move_to_end(prompt_id)     # 最新タスクは表示用に残す
+                if len(self.finished) == 1:
+                    break
+                continue
+            self.remove_locked(prompt_id)
+
+    # --- 参照 (いずれも O(1)、コピーを返す) ---
+    def get(self, prompt_id):
+        with self.lock:
+            record = self.tasks.get(prompt_id)
+            return copy_record(record) if record else None
+
+    def field(self, prompt_id, key, default=None):
+        with self.lock:
+            record = self.tasks.get(prompt_id)
+            return record.get(key, default) if record else default
+
+    def latest(self):
+        with self.lock:
+            if self.latest_id is None:
+                return None, None
+            return self.latest_id, copy_record(self.tasks[self.latest_id])
+
+    def is_done(self, prompt_id):
+        # ストアから消えたものも終了扱い
+        return prompt_id not in self.tasks or self.tasks[prompt_id][STATE] in FINISHED_STATES
+
+    def ids_in(self, state):
+        with self.lock:
+            return set(self.by_state[state])
+
+    def counts(self):
+        with self.lock:
+            return {state: len(ids) for state, ids in self.by_state.items()}
+
+    def wait_any_done(self, prompt_ids, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: any(self.is_done(pid) for pid in prompt_ids), timeout)
+            return [pid for pid in prompt_ids if self.is_done(pid)]
+
+    def __len__(self):
+        return len(self.tasks)
+
+def copy_record(record):
+    return {key: list(value) if isinstance(value, list) else value for key, value in record.items()}
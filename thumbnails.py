@@ -0,0 +1,24 @@
+import io
+from PIL import Image
+
+# サムネイル生成 (comfy_images のメモリキャッシュ用と comfy_postprocess のサイドカー用で共通)。
+# comfy_postprocess の spawn 子プロセスからも import されるので PIL 以外には依存しないこと。
+
+THUMB_SIZE = (256, 256)
+THUMB_FORMAT = "WEBP"
+THUMB_QUALITY = 80
+
+def render_thumbnail(image, size=THUMB_SIZE):
+    # 縮小したコピーを返す (元の image は変更しない)。WebP / JPEG で保存できるモードに揃える
+    thumb = image.copy()
+    thumb.thumbnail(size)
+    return thumb if thumb.mode in ("RGB", "RGBA") else thumb.convert("RGB")
+
+def save_args(fmt=THUMB_FORMAT):
+    return {"format": fmt, "quality": THUMB_QUALITY}
+
+def encode_thumbnail(data, size=THUMB_SIZE, fmt=THUMB_FORMAT):
+    with Image.open(io.BytesIO(data)) as image:
+        buf = io.BytesIO()
+        render_thumbnail(image, size).save(buf, **save_args(fmt))
+    return buf.getvalue()
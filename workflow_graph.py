@@ -0,0 +1,137 @@
+from collections import deque
+
+# API 形式ワークフローのグラフ索引 (ワークフローごとに 1 回だけ作る)。
+# - 順方向 / 逆方向の辺、トポロジカル順
+# - class_type・_meta.title・役割 (role) からのノード検索
+# 役割は接続から判定する:
+#   base_sampler    : 潜在画像を EmptyLatentImage 等から受け取るサンプラー
+#   refiner_sampler : 別のサンプラーの出力を受け取り、別の checkpoint を使うサンプラー (SDXL refiner)
+#   hires_sampler   : 別のサンプラーの出力を受け取り、同じ checkpoint を使うサンプラー (hires fix)
+#   positive / negative (+ base_ / refiner_ 付き) : サンプラーに繋がるテキストエンコーダー
+#   checkpoint (+ base_ / refiner_ 付き), latent, clip_skip, output
+
+SAMPLER_CLASSES = ("KSampler", "KSamplerAdvanced", "SamplerCustom", "SamplerCustomAdvanced")
+TEXT_ENCODER_CLASSES = ("CLIPTextEncode", "CLIPTextEncodeSDXL", "CLIPTextEncodeSDXLRefiner")
+CHECKPOINT_CLASSES = ("CheckpointLoaderSimple", "CheckpointLoader", "UNETLoader")
+LATENT_SOURCE_CLASSES = ("EmptyLatentImage", "EmptySD3LatentImage", "VAEEncode", "VAEEncodeForInpaint")
+CLIP_SKIP_CLASSES = ("CLIPSetLastLayer",)
+OUTPUT_CLASSES = ("SaveImage",)
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+class WorkflowGraph:
+    def __init__(self, workflow):
+        self.nodes = {str(node_id): node for node_id, node in workflow.items()}
+        self.upstream = {node_id: {} for node_id in self.nodes}      # node -> {input 名: (元 node, 出力番号)}
+        self.downstream = {node_id: [] for node_id in self.nodes}    # node -> [(先 node, input 名, 出力番号)]
+        for node_id, node in self.nodes.items():
+            for input_name, value in node.get("inputs", {}).items():
+                if is_link(value) and str(value[0]) in self.nodes:
+                    source = str(value[0])
+                    self.upstream[node_id][input_name] = (source, value[1])
+                    self.downstream[source].append((node_id, input_name, value[1]))
+        self.order = self.topological_order()
+        self.position = {node_id: i for i, node_id in enumerate(self.order)}
+        self.by_class = {}
+        self.by_title = {}
+        for node_id in self.order:
+            node = self.nodes[node_id]
+            self.by_class.setdefault(node.get("class_type"), []).append(node_id)
+            title = (node.get("_meta") or {}).get("title")
+            if title:
+                self.by_title.setdefault(title, []).append(node_id)
+        self.roles = self.find_roles()
+
+    def topological_order(self):
+        # Kahn 法。同順位はノード ID 順 (数値 ID は数値として比較)
+        def sort_key(node_id):
+            return (0, int(node_id), "") if node_id.isdigit() else (1, 0, node_id)
+        pending = {node_id: len(inputs) for node_id, inputs in self.upstream.items()}
+        ready = deque(sorted((n for n, count in pending.items() if count == 0), key=sort_key))
+        order = []
+        while ready:
+            node_id = ready.popleft()
+            order.append(node_id)
+            released = []
+            for target, _, _ in self.downstream[node_id]:
+                pending[target] -= 1
+                if pending[target] == 0:
+                    released.append(target)
+            ready.extend(sorted(set(released), key=sort_key))
+        if len(order) != len(self.nodes):
+            raise ValueError("workflow graph has a cycle")
+        return order
+
+    def class_of(self, node_id):
+        return self.nodes[node_id].get("class_type")
+
+    def trace(self, node_id, input_name, classes):
+        # input_name の接続元から上流へ幅優先でたどり、classes に該当する最も近いノードを返す
+        start = self.upstream[node_id].get(input_name)
+        if start is None:
+            return None
+        queue, seen = deque([start[0]]), {start[0]}
+        while queue:
+            current = queue.popleft()
+            if self.class_of(current) in classes:
+                return current
+            for source, _ in self.upstream[current].values():
+                if source not in seen:
+                    seen.add(source)
+                    queue.append(source)
+        return None
+
+    def find_roles(self):
+        roles = {}
+        def add(role, node_id):
+            if node_id is not None and node_id not in roles.setdefault(role, []):
+                roles[role].append(node_id)
+
+        samplers = [n for n in self.order if self.class_of(n) in SAMPLER_CLASSES]
+        checkpoint_of = {s: self.trace(s, "model", CHECKPOINT_CLASSES) for s in samplers}
+        for sampler in samplers:
+            source = self.trace(sampler, "latent_image", SAMPLER_CLASSES + LATENT_SOURCE_CLASSES)
+            if source in checkpoint_of:
+                stage = "refiner" if checkpoint_of[sampler] != checkpoint_of[source] else "hires"
+            else:
+                stage = "base"
+                if source is not None and self.class_of(source) in LATENT_SOURCE_CLASSES:
+                    add("latent", source)
+            add("sampler", sampler)
+            add(f"{stage}_sampler", sampler)
+            add("checkpoint", checkpoint_of[sampler])
+            if stage != "hires":
+                add(f"{stage}_checkpoint", checkpoint_of[sampler])
+            for polarity in ("positive", "negative"):
+                encoder = self.trace(sampler, polarity, TEXT_ENCODER_CLASSES)
+                add(polarity, encoder)
+                add(f"{stage}_{polarity}", encoder)
+                if encoder is not None:
+                    add("clip_skip", self.trace(encoder, "clip", CLIP_SKIP_CLASSES))
+        for node_id in self.order:
+            if self.class_of(node_id) in OUTPUT_CLASSES:
+                add("output", node_id)
+        return roles
+
+    def select(self, selector):
+        # "role:base_sampler" / "class:KSampler" / "title:Refiner" / "id:12" (接頭辞無しは role)
+        kind, _, value = selector.partition(":") if ":" in selector else ("role", "", selector)
+        if kind == "role":
+            return list(self.roles.get(value, []))
+        if kind == "class":
+            return list(self.by_class.get(value, []))
+        if kind == "title":
+            return list(self.by_title.get(value, []))
+        if kind == "id":
+            return [value] if value in self.nodes else []
+        raise ValueError(f"unknown selector: {selector}")
+
+    def bind(self, selector, input_name):
+        # 値を差し込める (node_id, input 名): 入力が存在し、他ノードからの接続でないものだけ
+        targets = []
+        for node_id in self.select(selector):
+            inputs = self.nodes[node_id].get("inputs", {})
+            if input_name in inputs and not is_link(inputs[input_name]):
+                targets.append((node_id, input_name))
+        return targets
@@ -0,0 +1,128 @@
+import json
+import hashlib
+import threading
+import workflow_utils as wu
+import workflow_graph as wg
+
+# ワークフローと node_ids からパラメータ → (node, input) の差し込み計画を作っておき、
+# ジョブごとには差し込むノードだけをコピーして残りはテンプレートと共有する。
+# テンプレート本体は変更されないので gr.State に置いた workflow が書き換わることもない。
+
+# パラメータ名 (generate_image_with_api の引数) -> [(node_ids のラベル, input 名)]
+PARAM_SLOTS = {
+    "seed":               [("KSampler", "seed")],
+    "steps":              [("KSampler", "steps")],
+    "cfg":                [("KSampler", "cfg")],
+    "sampler_name":       [("KSampler", "sampler_name")],
+    "scheduler":          [("KSampler", "scheduler")],
+    "denoise":            [("KSampler", "denoise")],
+    "width":              [("EmptyLatentImage", "width")],
+    "height":             [("EmptyLatentImage", "height")],
+    # SDXL対応: text_l, text_g 両方に設定
+    "positive_prompt":    [("PositivePrompt_TextEncode", key) for key in ("text", "text_g", "text_l")],
+    "negative_prompt":    [("NegativePrompt_TextEncode", key) for key in ("text", "text_g", "text_l")],
+    "filename_prefix":    [("SaveImage", "filename_prefix")],
+    "model_name":         [("CheckpointLoaderSimple", "ckpt_name")],
+    "stop_at_clip_layer": [("CLIPSetLastLayer", "stop_at_clip_layer")],
+}
+
+# グラフ索引 (workflow_graph) に対するパラメータ束縛: パラメータ名 -> [(セレクタ, input 名)]
+# 該当ノードに input が無いもの・他ノードから接続されているものには差し込まない。
+# base + refiner / hires fix の複数サンプラーでも、それぞれ正しいノードに入る。
+STAGE_SAMPLERS = ("role:base_sampler", "role:refiner_sampler")
+PARAM_BINDINGS = {
+    "seed":               [("role:sampler", key) for key in ("seed", "noise_seed")],
+    "steps":              [(sel, "steps") for sel in STAGE_SAMPLERS],
+    "cfg":                [(sel, "cfg") for sel in STAGE_SAMPLERS],
+    "sampler_name":       [(sel, "sampler_name") for sel in STAGE_SAMPLERS],
+    "scheduler":          [(sel, "scheduler") for sel in STAGE_SAMPLERS],
+    "denoise":            [("role:base_sampler", "denoise")],
+    "width":              [("role:latent", "width")],
+    "height":             [("role:latent", "height")],
+    "positive_prompt":    [("role:positive", key) for key in ("text", "text_g", "text_l")],
+    "negative_prompt":    [("role:negative", key) for key in ("text", "text_g", "text_l")],
+    "filename_prefix":    [("role:output", "filename_prefix")],
+    "model_name":         [("role:base_checkpoint", "ckpt_name")],
+    "stop_at_clip_layer": [("role:clip_skip", "stop_at_clip_layer")],
+    # img2img / inpaint: アップロード済みの画像名 (comfy_uploads.ensure_uploaded の戻り値)
+    "input_image":        [("class:LoadImage", "image")],
+    "input_mask":         [("class:LoadImageMask", "image")],
+}
+
+TEMPLATE_CACHE_SIZE = 32
+
+class CompiledTemplate:
+    def __init__(self, key, workflow, plan, graph=None):
+        self.key = key              # 内容ハッシュ
+        self.workflow = workflow    # 読み取り専用として扱う
+        self.plan = plan            # param -> [(node_id, input 名)]
+        self.graph = graph          # workflow_graph.WorkflowGraph
+
+    def __deepcopy__(self, memo):
+        # 変更されないので複製しない (gr.State はセッションごとに値を deepcopy する)
+        return self
+
+    def instantiate(self, **params):
+        prompt = dict(self.workflow)    # 差し込まないノードはテンプレートと共有
+        copied = set()
+        for param, value in params.items():
+            if param not in self.plan:
+                raise KeyError(f"unknown workflow parameter: {param}")
+            for node_id, input_name in self.plan[param]:
+                if node_id not in copied:
+                    node = dict(self.workflow[node_id])
+                    node["inputs"] = dict(node.get("inputs", {}))
+                    prompt[node_id] = node
+                    copied.add(node_id)
+                prompt[node_id]["inputs"][input_name] = value
+        return prompt
+
+def content_hash(workflow, node_ids, bindings=None):
+    canonical = json.dumps([workflow, node_ids, bindings], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest(), canonical
+
+def build_plan(node_ids, param_slots=PARAM_SLOTS):
+    # node_ids に無いノード (例: CLIPSetLastLayer の無いワークフロー) のスロットは空になる
+    plan = {}
+    for param, slots in param_slots.items():
+        plan[param] = [(node_ids[label], input_name) for label, input_name in slots if label in node_ids]
+    return plan
+
+def build_graph_plan(graph, bindings=PARAM_BINDINGS):
+    plan = {}
+    for param, targets in bindings.items():
+        slots = []
+        for selector, input_name in targets:
+            slots.extend(slot for slot in graph.bind(selector, input_name) if slot not in slots)
+        plan[param] = slots
+    return plan
+
+templates_lock = threading.Lock()
+templates = {}      # content hash -> CompiledTemplate (挿入順で古いものから破棄)
+
+def compile_template(workflow, node_ids=None, bindings=None):
+    # node_ids が自動検出結果と同じ (または省略) ならグラフ索引の束縛を使い、
+    # 手で指定された node_ids なら従来どおりそのラベルに差し込む
+    if isinstance(workflow, CompiledTemplate):
+        return workflow
+    if node_ids is not None and node_ids == wu.find_node_ids_from_connections(workflow):
+        node_ids = None
+    key, canonical = content_hash(workflow, node_ids, bindings)
+    with templates_lock:
+        template = templates.get(key)
+    if template is not None:
+        return template
+
+    # 呼び出し側が後で workflow を書き換えても影響しないよう正規化 JSON から複製を持つ
+    frozen_workflow, frozen_node_ids, frozen_bindings = json.loads(canonical)
+    graph = wg.WorkflowGraph(frozen_workflow)
+    if frozen_node_ids is None:
+        plan = build_graph_plan(graph, frozen_bindings or PARAM_BINDINGS)
+    else:
+        plan = build_plan(frozen_node_ids)
+    template = CompiledTemplate(key, frozen_workflow, plan, graph)
+    with templates_lock:
+        templates[key] = template
+        while len(templates) > TEMPLATE_CACHE_SIZE:
+            templates.pop(next(iter(templates)))
+    return template